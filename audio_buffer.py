@@ -0,0 +1,86 @@
+"""
+    Bounded buffer for the microphone audio of the camera tab. Keeps the newest samples in one preallocated NumPy array
+    that is written round robin, so memory stays the same no matter how long the tab stays open. The retention window
+    is given in seconds and additionally capped in bytes.
+"""
+
+import threading
+import numpy as np
+
+
+class AudioRingBuffer(object):
+
+    def __init__(self, sample_rate=48000, channels=1, retention=60.0, max_bytes=32 * 1024 * 1024, dtype=np.int16):
+        """
+        :param sample_rate: samples per second and channel
+        :param channels: number of channels of the chunks that get written
+        :param retention: seconds of audio that are kept, older samples get overwritten
+        :param max_bytes: hard cap for the size of the buffer, wins over retention
+        :param dtype: sample type, naoqi delivers 16 bit PCM
+        """
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+
+        bytes_per_frame = channels * self.dtype.itemsize
+        self.capacity = max(1, min(int(retention * sample_rate), max_bytes // bytes_per_frame))
+        self.data = np.zeros((channels, self.capacity), dtype=self.dtype)
+
+        self.lock = threading.Lock()
+        self.written = 0  # samples per channel ever written, the newest sample is at (written - 1) % capacity
+
+    def write(self, chunk):
+        """
+        Copies a chunk into the buffer, overwriting the oldest samples if it is full.
+        :param chunk: array of shape (channels, samples)
+        """
+        samples = chunk.shape[1]
+        if samples > self.capacity:
+            chunk = chunk[:, -self.capacity:]  # only the end of a chunk longer than the whole buffer is kept
+            skipped = samples - self.capacity
+            samples = self.capacity
+        else:
+            skipped = 0
+
+        with self.lock:
+            self.written += skipped
+            start = self.written % self.capacity
+            first = min(samples, self.capacity - start)
+            self.data[:, start:start + first] = chunk[:, :first]
+            if first < samples:
+                self.data[:, :samples - first] = chunk[:, first:]  # wraps around
+            self.written += samples
+
+    def available(self):
+        """
+        :return: samples per channel that are currently kept
+        """
+        with self.lock:
+            return min(self.written, self.capacity)
+
+    def duration(self):
+        """
+        :return: seconds of audio that are currently kept
+        """
+        return self.available() / float(self.sample_rate)
+
+    def last(self, seconds=None):
+        """
+        Copies out the newest audio, only the requested part of the buffer is touched.
+        :param seconds: how much of the newest audio, None for everything that is kept
+        :return: array of shape (channels, samples), oldest sample first
+        """
+        with self.lock:
+            count = min(self.written, self.capacity)
+            if seconds is not None:
+                count = min(count, int(seconds * self.sample_rate))
+
+            end = self.written % self.capacity
+            start = end - count
+            if start >= 0:
+                return self.data[:, start:end].copy()
+            return np.concatenate((self.data[:, start:], self.data[:, :end]), axis=1)
+
+    def clear(self):
+        with self.lock:
+            self.written = 0
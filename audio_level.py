@@ -0,0 +1,131 @@
+"""
+    Level meter and simple voice activity detection on the live audio of the camera tab, so the operator sees if
+    someone is talking without listening. Consumer of the audio pipeline: RMS and peak are computed with NumPy for all
+    20ms frames of a chunk at once. A frame counts as voiced when it is clearly louder than the noise floor, which
+    follows the quietest frames. Speech starts after a short run of voiced frames and stops after a hangover of
+    unvoiced ones, both are reported as events with timestamps. Nothing of the audio itself leaves the server.
+"""
+
+import threading
+import time
+import numpy as np
+from timeit import default_timer as timer
+
+
+def to_db(value):
+    # dB relative to full scale, silence is clipped at -120
+    return 20.0 * np.log10(np.maximum(value, 1e-6))
+
+
+class AudioLevelMeter(object):
+
+    def __init__(self, sample_rate, on_event=None, frame_seconds=0.02, margin_db=12.0, min_db=-50.0, onset=0.06,
+                 hangover=0.4, floor_rise=3.0, level_interval=0.2):
+        """
+        :param sample_rate: samples per second and channel of the chunks
+        :param on_event: callable taking event name and data, eg the publish of the event hub. "voice" is sent when
+        speech starts and stops, "audio_level" every level_interval seconds
+        :param frame_seconds: length of the frames the levels are computed for
+        :param margin_db: how much louder than the noise floor a frame has to be to count as voiced
+        :param min_db: frames quieter than this never count as voiced, in dB full scale
+        :param onset: seconds of voiced frames before speech is reported, so clicks don't count
+        :param hangover: seconds of unvoiced frames before the end of speech is reported, so short pauses don't count
+        :param floor_rise: dB per second the noise floor rises while nothing is quieter, it drops immediately
+        :param level_interval: seconds between two audio_level events, None for no level events
+        """
+        self.frame_size = max(1, int(sample_rate * frame_seconds))
+        self.frame_seconds = self.frame_size / float(sample_rate)
+        self.sample_rate = float(sample_rate)
+        self.on_event = on_event
+        self.margin_db = margin_db
+        self.min_db = min_db
+        self.onset = onset
+        self.hangover = hangover
+        self.floor_rise = floor_rise
+        self.level_interval = level_interval
+
+        self.lock = threading.Lock()
+        self.noise_floor = None  # dB
+        self.speaking = False
+        self.run_length = 0.0  # seconds the frames disagree with the current state
+        self.run_started = None  # timestamp of the first frame of that run
+        self.last_start = None
+        self.last_stop = None
+        self.next_level_event = 0.0
+        self.level = {}
+
+    def __call__(self, chunk, received_at):
+        """
+        Consumer for the AudioPipeline.
+        """
+        samples = chunk[0] if chunk.shape[0] == 1 else chunk.mean(axis=0)
+        count = len(samples) // self.frame_size * self.frame_size
+        if count == 0:
+            return
+
+        frames = samples[:count].reshape(-1, self.frame_size).astype(np.float32) / 32768.0
+        power = np.mean(frames * frames, axis=1)
+        rms = to_db(np.sqrt(power))
+        chunk_rms = to_db(np.sqrt(power.mean()))
+        peak = to_db(np.abs(frames).max())
+
+        # received_at is when the end of the chunk arrived, frame i started that long before plus its offset
+        chunk_started = time.time() - (timer() - received_at) - len(samples) / self.sample_rate
+        events = []
+
+        with self.lock:
+            quietest = float(rms.min())
+            if self.noise_floor is None or quietest < self.noise_floor:
+                self.noise_floor = quietest
+            else:
+                self.noise_floor += self.floor_rise * len(samples) / self.sample_rate
+
+            voiced = rms > max(self.noise_floor + self.margin_db, self.min_db)
+
+            for i, is_voiced in enumerate(voiced):
+                if is_voiced == self.speaking:
+                    self.run_length = 0.0
+                    continue
+
+                timestamp = chunk_started + i * self.frame_seconds
+                if self.run_length == 0.0:
+                    self.run_started = timestamp
+                self.run_length += self.frame_seconds
+
+                if self.run_length >= (self.hangover if self.speaking else self.onset):
+                    # speech starts (stops) at the first voiced (unvoiced) frame of the run
+                    self.speaking = not self.speaking
+                    self.run_length = 0.0
+                    if self.speaking:
+                        self.last_start = self.run_started
+                    else:
+                        self.last_stop = self.run_started
+                    events.append(("voice", {
+                        "speaking": self.speaking,
+                        "timestamp": self.run_started
+                    }))
+
+            self.level = {
+                "rms_db": round(float(chunk_rms), 1),
+                "peak_db": round(float(peak), 1),
+                "noise_floor_db": round(self.noise_floor, 1),
+                "speaking": self.speaking,
+                "speech_started": self.last_start,
+                "speech_stopped": self.last_stop,
+                "timestamp": chunk_started + len(samples) / self.sample_rate
+            }
+
+            if self.level_interval is not None and received_at >= self.next_level_event:
+                self.next_level_event = received_at + self.level_interval
+                events.append(("audio_level", dict(self.level)))
+
+        if self.on_event is not None:
+            for event, data in events:
+                self.on_event(event, data)
+
+    def snapshot(self):
+        """
+        :return: dict with the levels (dB full scale) of the newest chunk and the state of the voice activity detection
+        """
+        with self.lock:
+            return dict(self.level)
@@ -0,0 +1,345 @@
+"""
+    Audio path of the camera tab, decoupled from the naoqi callback thread. The callback only hands the chunks of
+    Pepper's microphones (zero-copy NumPy views) to the AudioPipeline, whose thread passes them on to the consumers, eg
+    the ring buffer and the JitterBufferPlayback. The playback has its own thread feeding sounddevice from an adaptive
+    jitter buffer, so a hiccup of the output device never backs up the audio delivery of the robot.
+    The AudioFanout streams the same audio to any number of browsers (/audio_feed), for operators on other machines.
+"""
+
+import threading
+import struct
+import logging
+import Queue
+from collections import deque
+from timeit import default_timer as timer
+
+
+log = logging.getLogger("woz4u.audio")
+
+
+class AudioPipeline(object):
+
+    def __init__(self, max_queued=64):
+        """
+        :param max_queued: chunks waiting for the consumers, further chunks are dropped (and counted) until there is room
+        """
+        self.queue = Queue.Queue(maxsize=max_queued)
+        self.consumers = []  # callables taking (chunk, received_at)
+        self.thread = None
+
+        self.chunks = 0
+        self.overruns = 0  # chunks dropped because the consumers didn't keep up
+
+    def add_consumer(self, consumer):
+        """
+        :param consumer: callable taking the chunk (array of shape (channels, samples), read only) and the timer()
+        timestamp of when it was received. Called on the thread of the pipeline, must not keep it busy for long
+        """
+        self.consumers.append(consumer)
+
+    def submit(self, chunk):
+        """
+        Queues one chunk for the consumers, never blocks. Called from the naoqi callback thread.
+        """
+        try:
+            self.queue.put_nowait((chunk, timer()))
+        except Queue.Full:
+            self.overruns += 1
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="AudioPipeline")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.thread = None
+        try:
+            self.queue.put_nowait(None)
+        except Queue.Full:
+            # consumers are stuck, make room for the stop marker
+            self.drain()
+            self.queue.put_nowait(None)
+
+    def drain(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            chunk, received_at = item
+            self.chunks += 1
+            for consumer in self.consumers:
+                try:
+                    consumer(chunk, received_at)
+                except Exception:
+                    # a broken consumer must not take the audio away from the others
+                    log.exception("Audio consumer %s failed", consumer)
+
+
+class JitterBufferPlayback(object):
+    """
+    Plays the chunks on an output stream from its own thread. Playback starts once the jitter buffer holds the target
+    latency worth of audio. When the output device runs out of samples (underrun, the chunks of the robot came in too
+    late), the target grows and the buffer fills up again before playing on, after a while without underruns it shrinks
+    back step by step. When the buffer grows over max_latency (the device plays slower than the robot records, or a
+    stall), the oldest audio is dropped (overrun), so the delay never builds up.
+    """
+
+    def __init__(self, open_stream, sample_rate, target_latency=0.1, min_latency=0.05, max_latency=0.5,
+                 relax_after=10.0):
+        """
+        :param open_stream: callable returning a new, not yet started sounddevice output stream
+        :param sample_rate: samples per second and channel of the chunks
+        :param target_latency: seconds of audio buffered before playback starts
+        :param min_latency: the target never shrinks below this
+        :param max_latency: max seconds of audio in the buffer, the target never grows above this either
+        :param relax_after: seconds without underrun after which the target shrinks by one step
+        """
+        self.open_stream = open_stream
+        self.sample_rate = float(sample_rate)
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.relax_after = relax_after
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.chunks = deque()  # (chunk, received_at)
+        self.buffered = 0  # samples per channel in the buffer
+        self.target = max(min_latency, min(target_latency, max_latency))
+        self.prebuffering = True
+        self.last_underrun = timer()
+        self.running = False
+        self.generation = 0  # increased on every start, so the thread of a previous start ends even if started again
+
+        self.underruns = 0  # the output device ran out of samples while playing
+        self.overruns = 0  # chunks dropped because the buffer was over max_latency
+        self.latency = None  # seconds from receiving a chunk until it is played, moving average
+        self.latency_last = None
+
+    def __call__(self, chunk, received_at):
+        """
+        Consumer for the AudioPipeline, adds a chunk to the jitter buffer, never blocks for long.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            self.chunks.append((chunk, received_at))
+            self.buffered += chunk.shape[1]
+
+            while len(self.chunks) > 1 and self.buffered / self.sample_rate > self.max_latency:
+                dropped, _ = self.chunks.popleft()
+                self.buffered -= dropped.shape[1]
+                self.overruns += 1
+
+            self.available.notify()
+
+    def start(self):
+        stream = self.open_stream()
+        stream.start()
+
+        with self.lock:
+            if self.running:
+                stream.close()
+                return
+            self.running = True
+            self.prebuffering = True
+            self.last_underrun = timer()
+            self.generation += 1
+            generation = self.generation
+
+        thread = threading.Thread(target=self.run, args=(stream, generation), name="AudioPlayback")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stops the playback, the thread closes the stream once its current write returned.
+        """
+        with self.lock:
+            self.running = False
+            self.chunks.clear()
+            self.buffered = 0
+            self.available.notify_all()
+
+    def next_chunk(self, generation):
+        """
+        :return: the next (chunk, received_at) to play, None when the playback got stopped
+        """
+        with self.lock:
+            while self.running and generation == self.generation:
+                now = timer()
+                if self.prebuffering:
+                    if self.buffered / self.sample_rate >= self.target:
+                        self.prebuffering = False
+                elif now - self.last_underrun > self.relax_after and self.target > self.min_latency:
+                    self.target = max(self.min_latency, self.target * 0.9)
+                    self.last_underrun = now
+
+                if not self.prebuffering and self.chunks:
+                    chunk, received_at = self.chunks.popleft()
+                    self.buffered -= chunk.shape[1]
+                    return chunk, received_at
+
+                self.available.wait(0.1)
+        return None
+
+    def run(self, stream, generation):
+        try:
+            while True:
+                item = self.next_chunk(generation)
+                if item is None:
+                    return
+
+                chunk, received_at = item
+                # sounddevice expects columns to be channels, and we get rows as channels
+                if stream.write(chunk.T):
+                    self.underrun()
+
+                # write returns once the chunk is in the output buffer, it is heard after the latency of the device
+                latency = timer() - received_at + stream.latency
+                self.latency_last = latency
+                self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+        finally:
+            stream.close()
+
+    def underrun(self):
+        # the device played silence before this chunk, buffer more before going on
+        with self.lock:
+            self.underruns += 1
+            self.last_underrun = timer()
+            self.target = min(self.max_latency, self.target * 1.5)
+            self.prebuffering = True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "buffered_seconds": round(self.buffered / self.sample_rate, 3),
+                "target_seconds": round(self.target, 3),
+                "underruns": self.underruns,
+                "overruns": self.overruns,
+                "latency": round(self.latency, 3) if self.latency is not None else None,
+                "latency_last": round(self.latency_last, 3) if self.latency_last is not None else None
+            }
+
+
+def wav_header(sample_rate, channels, data_size=None, sample_width=2):
+    """
+    :param data_size: bytes of audio following the header, None for a stream of unknown length. The sizes are then
+    set to the max, browsers play such a stream until it ends
+    :return: header of a 16 bit PCM .wav file
+    """
+    byte_rate = sample_rate * channels * sample_width
+    riff_size = 0xFFFFFFFF if data_size is None else min(0xFFFFFFFF, 36 + data_size)
+    return (b"RIFF" + struct.pack("<I", riff_size) + b"WAVE" +
+            b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, byte_rate, channels * sample_width,
+                                  8 * sample_width) +
+            b"data" + struct.pack("<I", 0xFFFFFFFF if data_size is None else data_size))
+
+
+class AudioListener(object):
+    """
+    One client of the AudioFanout, typically one open /audio_feed connection. Has its own bounded queue, when the
+    client doesn't keep up its oldest audio is dropped, so it never blocks the others and its delay never builds up.
+    """
+
+    def __init__(self, maxsize):
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, data):
+        while True:
+            try:
+                self.queue.put_nowait(data)
+                return
+            except Queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        """
+        :return: the next interleaved PCM bytes, None if there was no audio within the timeout
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+class AudioFanout(object):
+    """
+    Consumer for the AudioPipeline that hands every chunk to all listeners. The chunk is converted to interleaved PCM
+    bytes once, no matter how many listeners there are.
+    """
+
+    def __init__(self, sample_rate, channels, max_queued=8):
+        """
+        :param max_queued: chunks (~85ms each at 48kHz) queued per listener, older ones are dropped
+        """
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.listeners = set()
+
+    def __call__(self, chunk, received_at):
+        if chunk.shape[0] != self.channels:
+            return
+        with self.lock:
+            listeners = list(self.listeners)
+        if not listeners:
+            return
+
+        # sample by sample, all channels of a sample after each other
+        data = chunk.T.tobytes()
+        for listener in listeners:
+            listener.put(data)
+
+    def subscribe(self):
+        listener = AudioListener(self.max_queued)
+        with self.lock:
+            self.listeners.add(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            self.listeners.discard(listener)
+
+    def wav_stream(self, idle_timeout=0.25):
+        """
+        Generator for one listener of the .wav stream. While no audio comes in (camera tab closed, audio muted), it
+        sends idle_timeout seconds of silence every idle_timeout seconds, so the browser keeps playing and we notice
+        when it went away.
+        """
+        listener = self.subscribe()
+        silence = b"\x00" * (int(self.sample_rate * idle_timeout) * self.channels * 2)
+
+        # the finally also runs when the server closes the generator because the client went away
+        try:
+            yield wav_header(self.sample_rate, self.channels)
+            while True:
+                data = listener.get(timeout=idle_timeout)
+                yield data if data is not None else silence
+        finally:
+            self.unsubscribe(listener)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "listeners": len(self.listeners),
+                "dropped": sum(listener.dropped for listener in self.listeners)
+            }
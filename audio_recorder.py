@@ -0,0 +1,132 @@
+"""
+    Background recorder for the live audio of the camera tab on the host. The audio pipeline hands the chunks to a
+    bounded queue, one thread appends them to .wav files. The header is written up front with the sizes left open and
+    patched when a file is closed (and every few seconds, so a crash loses little), no raw file that gets converted
+    afterwards. Files are rotated after a max duration or size, so a recording can run for hours with constant memory.
+"""
+
+import os
+import time
+import errno
+
+from audio_pipeline import wav_header
+from background_writer import BackgroundWriter
+
+
+class WavRecorder(BackgroundWriter):
+
+    def __init__(self, save_dir, sample_rate, channels, rotate_seconds=1800.0, rotate_bytes=512 * 1024 * 1024,
+                 max_queued=256, sync_interval=5.0):
+        """
+        :param save_dir: folder for the .wav files, named after the time they were started
+        :param sample_rate: samples per second and channel of the chunks
+        :param channels: number of channels of the chunks, chunks with other numbers are skipped
+        :param rotate_seconds: seconds of audio after which the next file is started
+        :param rotate_bytes: audio bytes after which the next file is started, stays below the 4GB limit of .wav
+        :param max_queued: chunks waiting to be written, further chunks are dropped (and counted) until there is room
+        :param sync_interval: seconds between header updates of the open file
+        """
+        self.save_dir = save_dir
+        self.sample_rate = sample_rate
+        self.channels = channels
+        frame_size = channels * 2
+        max_bytes = min(int(rotate_seconds * sample_rate) * frame_size, rotate_bytes, 0xFFFFFFFF - 36)
+        self.rotate_bytes = max(frame_size, max_bytes // frame_size * frame_size)  # whole samples only
+        self.sync_interval = sync_interval
+
+        self.file = None
+        self.file_bytes = 0  # audio bytes in the open file
+        self.last_sync = 0.0
+        self.files = []  # paths of all files of this recording
+
+        self.written = 0  # chunks
+        self.dropped = 0
+
+        BackgroundWriter.__init__(self, "WavRecorder", max_queued)
+
+    def submit(self, chunk):
+        """
+        Queues one chunk for writing, never blocks.
+        :param chunk: array of shape (channels, samples)
+        :return: False if the chunk had to be dropped because the writer doesn't keep up
+        """
+        if chunk.shape[0] != self.channels:
+            return False
+        if self.put(chunk):
+            return True
+        self.dropped += 1
+        return False
+
+    def write_batch(self, batch):
+        for chunk in batch:
+            self.write(chunk.T.tobytes())  # sample by sample, all channels of a sample after each other
+
+    def write(self, data):
+        frame_size = self.channels * 2
+        while data:
+            if self.file is None or self.file_bytes >= self.rotate_bytes:
+                self.start_file()
+
+            # split at the rotation point, so that every file has exactly the max duration
+            room = (self.rotate_bytes - self.file_bytes) // frame_size * frame_size
+            part, data = data[:room], data[room:]
+            self.file.write(part)
+            self.file_bytes += len(part)
+
+        self.written += 1
+        if time.time() - self.last_sync > self.sync_interval:
+            self.patch_header()
+            self.file.flush()
+
+    def start_file(self):
+        self.close()
+        if not os.path.exists(self.save_dir):
+            os.makedirs(self.save_dir)
+
+        path = self.create_file(time.strftime("%Y.%m.%d-%H:%M:%S"))
+        self.file.write(wav_header(self.sample_rate, self.channels, 0))
+        self.file_bytes = 0
+        self.last_sync = time.time()
+        self.files.append(path)
+
+    def create_file(self, name):
+        """
+        Opens a new file named after the given time, with a counter suffix that is bumped until the name is free, so
+        neither a rotation nor a second recorder started in the same second overwrites a file.
+        :return: path of the new file, which is open as self.file
+        """
+        suffix = len(self.files)
+        while True:
+            path = os.path.join(self.save_dir, "{}-{}.wav".format(name, suffix))
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                suffix += 1
+                continue
+            self.file = os.fdopen(fd, "wb")
+            return path
+
+    def patch_header(self):
+        # writes the complete header again, with the current sizes
+        self.file.seek(0)
+        self.file.write(wav_header(self.sample_rate, self.channels, self.file_bytes))
+        self.file.seek(0, os.SEEK_END)
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.patch_header()
+            finally:
+                # a file we can't write to anymore is closed anyway, the next chunk starts a new one
+                self.file.close()
+                self.file = None
+
+    def stats(self):
+        stats = BackgroundWriter.stats(self)
+        stats["written"] = self.written
+        stats["dropped"] = self.dropped
+        stats["files"] = list(self.files)
+        return stats
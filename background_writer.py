@@ -0,0 +1,96 @@
+"""
+    Base of the recorders that write to disk in the background (frames, audio, sessions): the producers put records
+    into a bounded queue without ever blocking, one thread takes them out in batches and writes them. A failing write
+    is logged and counted, the thread keeps draining the queue, so neither the producers nor stop() can hang on a
+    writer that died. stop() only sets an event, the thread writes what is still queued, closes and ends.
+"""
+
+import logging
+import threading
+import Queue
+
+
+log = logging.getLogger("woz4u.writer")
+
+
+class BackgroundWriter(object):
+
+    poll_interval = 0.1  # seconds the thread waits for records before it checks whether it was stopped
+
+    def __init__(self, name, max_queued, batch_size=1):
+        """
+        Subclasses call this last in their __init__, it starts the thread.
+        :param name: name of the thread, also used in the log
+        :param max_queued: records waiting to be written, put() refuses further records until there is room
+        :param batch_size: max number of records handed to write_batch in one go
+        """
+        self.batch_size = batch_size
+        self.queue = Queue.Queue(maxsize=max_queued)
+        self.stop_event = threading.Event()
+        self.errors = 0
+        self.last_error = None
+
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        """
+        Queues one record, never blocks.
+        :return: False if the record was refused because the queue is full or the writer is stopped
+        """
+        if self.stop_event.is_set():
+            return False
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            return False
+
+    def stop(self):
+        """
+        Lets the writer finish all queued records, then it closes and ends its thread. Doesn't wait for that.
+        """
+        self.stop_event.set()
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    batch = [self.queue.get(timeout=self.poll_interval)]
+                except Queue.Empty:
+                    if self.stop_event.is_set():
+                        return
+                    continue
+
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                try:
+                    self.write_batch(batch)
+                except Exception as e:
+                    # eg a full disk, the records are lost but the next batch might make it
+                    self.errors += 1
+                    self.last_error = str(e)
+                    log.exception("%s failed to write %d records", self.thread.name, len(batch))
+        finally:
+            try:
+                self.close()
+            except Exception:
+                log.exception("%s failed to close", self.thread.name)
+
+    def write_batch(self, batch):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "errors": self.errors,
+            "last_error": self.last_error
+        }
@@ -0,0 +1,85 @@
+"""
+    Micro-benchmark for the ALImage to JPEG conversion of the camera stream.
+    Compares the old path (str(bytearray(...)) + Image.frombytes + fresh BytesIO per frame) with the buffer based path
+    and the reusing JpegEncoder from utils.py, for the resolutions we can subscribe to.
+
+    Usage: python benchmarks/image_conversion.py [-n FRAMES]
+"""
+
+import argparse
+import io
+import os
+import sys
+from timeit import default_timer as timer
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from utils import alImage_to_JPEG
+from utils import alImage_to_PIL
+from utils import JpegEncoder
+
+RESOLUTIONS = [
+    ("QVGA", 320, 240),
+    ("VGA", 640, 480),
+    ("4VGA", 1280, 960),
+]
+
+
+def fake_alImage(width, height, data_type):
+    """
+    Builds something that looks like the return value of ALVideoDevice.getImageRemote. Pixels are a gradient with some
+    noise, so that the JPEG encoder has roughly as much work as with a real camera frame.
+    """
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 32)
+    pixels = Image.merge("RGB", (gradient, noise, gradient.rotate(90))).tobytes()
+
+    return [width, height, 3, 11, 0, 0, data_type(pixels)]
+
+
+def old_alImage_to_PIL(alImg):
+    im_str = str(bytearray(alImg[6]))
+    return Image.frombytes("RGB", (alImg[0], alImg[1]), im_str)
+
+
+def old_conversion(alImg):
+    pil_img = old_alImage_to_PIL(alImg)
+
+    imgByteArr = io.BytesIO()
+    pil_img.save(imgByteArr, format="jpeg")
+    return imgByteArr.getvalue()
+
+
+def time_per_frame(func, frames):
+    func()  # warm up
+    start = timer()
+    for _ in range(frames):
+        func()
+    return (timer() - start) / frames * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", dest="frames", default=100, type=int, help="How many frames to convert per measurement.")
+    args = parser.parse_args()
+
+    encoder = JpegEncoder()
+
+    # "to PIL" is only the ALImage to Pillow conversion, "to JPEG" the whole path including encoding
+    print("{:<6} {:<10} {:>14} {:>14} {:>15} {:>15}".format(
+        "res", "payload", "old to PIL ms", "new to PIL ms", "old to JPEG ms", "new to JPEG ms"))
+    for name, width, height in RESOLUTIONS:
+        for data_type in (str, bytearray):
+            alImg = fake_alImage(width, height, data_type)
+
+            print("{:<6} {:<10} {:>14.3f} {:>14.3f} {:>15.3f} {:>15.3f}".format(
+                name, data_type.__name__,
+                time_per_frame(lambda: old_alImage_to_PIL(alImg), args.frames),
+                time_per_frame(lambda: alImage_to_PIL(alImg), args.frames),
+                time_per_frame(lambda: old_conversion(alImg), args.frames),
+                time_per_frame(lambda: alImage_to_JPEG(alImg, encoder), args.frames)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+    Load test for a running WoZ4U server, to compare the server modes (--server dev / threaded / cheroot).
+    Simulates several operator tabs: each one keeps an event stream open and sends requests back to back over a
+    keep-alive connection, plus a number of camera viewers reading /video_feed. Reports requests per second, latencies
+    and the frame rate every viewer got.
+    The camera viewers need a connected robot with an open camera tab, without one only the requests are measured.
+
+    Usage: python benchmarks/server_load.py [--url http://localhost:5000] [--robot IP] [--tabs 4] [--streams 2]
+                                            [--duration 10] [--path /querry_states]
+"""
+
+import argparse
+import httplib
+import socket
+import threading
+import urllib
+import urlparse
+from timeit import default_timer as timer
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.frames = 0
+        self.status = None
+
+    def add_latency(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+
+def connect(url, timeout=10):
+    parsed = urlparse.urlparse(url)
+    return httplib.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+
+
+def with_robot(path, robot):
+    if robot is None:
+        return path
+    return path + ("&" if "?" in path else "?") + urllib.urlencode({"robot": robot})
+
+
+def operator_tab(url, path, deadline, counter):
+    """
+    Sends requests back to back over one keep-alive connection, like a busy operator tab.
+    """
+    conn = connect(url)
+    while timer() < deadline:
+        started = timer()
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                raise httplib.HTTPException(response.status)
+            counter.add_latency(timer() - started)
+        except (httplib.HTTPException, IOError):
+            counter.add_error()
+            conn.close()
+            conn = connect(url)
+    conn.close()
+
+
+def read_stream(url, path, deadline, counter, boundary):
+    """
+    Reads a streaming response until the deadline and counts the lines starting with the boundary, ie the MJPEG frames
+    or the server-sent events. Plain socket, httplib reads unbuffered (one recv per byte for readline).
+    """
+    parsed = urlparse.urlparse(url)
+    try:
+        sock = socket.create_connection((parsed.hostname, parsed.port or 80), timeout=10)
+    except IOError:
+        counter.add_error()
+        return
+
+    try:
+        sock.sendall("GET {} HTTP/1.1\r\nHost: {}\r\n\r\n".format(path, parsed.netloc))
+        stream = sock.makefile("rb")
+        counter.status = int(stream.readline().split()[1])
+        if counter.status != 200:
+            return
+
+        while timer() < deadline:
+            # line by line, read(n) would wait for n bytes and the events are tiny
+            line = stream.readline()
+            if not line:
+                break
+            if line.startswith(boundary):
+                counter.frames += 1
+    except (IndexError, ValueError, IOError):
+        counter.add_error()
+    finally:
+        sock.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", dest="url", default="http://localhost:5000", type=str, help="Where the server runs.")
+    parser.add_argument("--robot", dest="robot", default=None, type=str,
+                        help="IP of the robot to talk to, default is the robot connected last.")
+    parser.add_argument("--tabs", dest="tabs", default=4, type=int, help="How many operator tabs to simulate.")
+    parser.add_argument("--streams", dest="streams", default=2, type=int, help="How many camera viewers to simulate.")
+    parser.add_argument("--duration", dest="duration", default=10.0, type=float, help="Seconds to run the load for.")
+    parser.add_argument("--path", dest="path", default="/querry_states", type=str,
+                        help="What the operator tabs request, /alive_test for the bare server overhead.")
+    args = parser.parse_args()
+
+    deadline = timer() + args.duration
+    threads = []
+    requests = []
+    events = []
+    viewers = []
+
+    for _ in range(args.tabs):
+        counter = Counter()
+        requests.append(counter)
+        threads.append(threading.Thread(target=operator_tab, args=(
+            args.url, with_robot(args.path, args.robot), deadline, counter)))
+
+        counter = Counter()
+        events.append(counter)
+        threads.append(threading.Thread(target=read_stream, args=(
+            args.url, with_robot("/event_stream", args.robot), deadline, counter, "event: ")))
+
+    for _ in range(args.streams):
+        counter = Counter()
+        viewers.append(counter)
+        threads.append(threading.Thread(target=read_stream, args=(
+            args.url, with_robot("/video_feed", args.robot), deadline, counter, "--frame")))
+
+    started = timer()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = timer() - started
+
+    latencies = [latency * 1000.0 for counter in requests for latency in counter.latencies]
+    print("{} operator tabs requesting {} for {:.1f}s".format(args.tabs, args.path, elapsed))
+    print("  requests/s: {:.1f}  errors: {}".format(len(latencies) / elapsed, sum(c.errors for c in requests)))
+    print("  latency ms: p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  max {:.1f}".format(
+        percentile(latencies, 0.5), percentile(latencies, 0.95), percentile(latencies, 0.99),
+        max(latencies) if latencies else float("nan")))
+    print("  events per tab stream: {}".format([counter.frames for counter in events]))
+
+    for i, counter in enumerate(viewers):
+        if counter.status != 200:
+            print("camera viewer {}: HTTP {} (no camera tab open?)".format(i, counter.status))
+        else:
+            print("camera viewer {}: {:.1f} fps, {} frames".format(i, counter.frames / elapsed, counter.frames))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,363 @@
+"""
+    Single-grabber camera broadcaster. One capture thread per camera subscription fetches every frame from the robot
+    and encodes it to JPEG exactly once, any number of /video_feed viewers (and /camera/snapshot) are served from the
+    shared latest-frame slot.
+    Viewers can ask for a smaller size, lower JPEG quality or lower fps than what is captured, and can let the stream
+    adapt these automatically to how fast their connection takes the frames.
+"""
+
+import logging
+import threading
+import time
+import math
+from datetime import datetime
+from collections import namedtuple
+from collections import deque
+from timeit import default_timer as timer
+
+from PIL import Image
+
+from utils import alImage_to_JPEG
+from utils import JpegEncoder
+
+
+log = logging.getLogger("woz4u.camera")
+
+# seq: increasing frame number, etag: unique over broadcaster restarts, captured_at: wall clock datetime,
+# image: the decoded Pillow image, renditions: cache of re-encoded (size, quality) variants of this frame
+Frame = namedtuple("Frame", ["seq", "jpeg", "etag", "captured_at", "image", "renditions"])
+
+# frame sizes of the naoqi camera resolutions, by the names used in the config and in query strings
+RESOLUTIONS = {
+    "qqvga": (160, 120),
+    "qvga": (320, 240),
+    "vga": (640, 480),
+    "4vga": (1280, 960),
+}
+
+DEFAULT_QUALITY = 75  # same as Pillow's default
+
+
+class ViewerSettings(object):
+    """
+    What a single viewer of the stream asked for.
+    """
+
+    def __init__(self, width=None, quality=DEFAULT_QUALITY, fps=None, adaptive=False):
+        """
+        :param width: max width of the frames, the aspect ratio is kept. None for the captured size
+        :param quality: max JPEG quality, 1 - 95
+        :param fps: max frames per second, None for every captured frame
+        :param adaptive: whether size and quality get reduced automatically when the viewer can't keep up
+        """
+        self.width = width
+        self.quality = max(1, min(95, quality))
+        self.fps = fps if fps else None
+        self.adaptive = adaptive
+
+
+class AdaptiveQuality(object):
+    """
+    Steps a viewer down a ladder of (size, quality) levels while sending a frame takes a big part of the frame
+    interval, and slowly back up once the connection has headroom again.
+    """
+
+    # from best to worst: (scale of the requested width, scale of the requested JPEG quality)
+    LADDER = [(1.0, 1.0), (1.0, 0.75), (0.75, 0.75), (0.5, 0.75), (0.5, 0.5), (0.25, 0.5)]
+
+    def __init__(self, frame_interval, smoothing=0.3, down_after=1.0, up_after=3.0):
+        """
+        :param frame_interval: seconds between two frames the viewer should get
+        :param smoothing: weight of the newest measurement in the moving average of the send time
+        :param down_after: min seconds between two steps down
+        :param up_after: min seconds of headroom before stepping back up
+        """
+        self.frame_interval = frame_interval
+        self.smoothing = smoothing
+        self.down_after = down_after
+        self.up_after = up_after
+
+        self.level = 0
+        self.send_time = 0.0
+        self.last_step_down = 0.0
+        self.headroom_since = None
+
+    def current(self):
+        return self.LADDER[self.level]
+
+    def update(self, send_time, frame_age):
+        """
+        :param send_time: seconds it took to hand the last frame to the client
+        :param frame_age: seconds between capturing the last frame and it being sent, grows with a backlog
+        """
+        self.send_time += self.smoothing * (send_time - self.send_time)
+        load = max(self.send_time, frame_age) / self.frame_interval
+
+        now = timer()
+        if load < 0.2:
+            if self.headroom_since is None:
+                self.headroom_since = now
+            elif self.level > 0 and now - self.headroom_since >= self.up_after:
+                self.level -= 1
+                self.headroom_since = now
+        else:
+            self.headroom_since = None
+
+            if load > 0.5 and self.level < len(self.LADDER) - 1 and now - self.last_step_down >= self.down_after:
+                self.level += 1
+                self.last_step_down = now
+
+
+class FramePacer(object):
+    """
+    Schedules the frame fetches of the capture thread to the fps of the camera subscription, measures the frame rate
+    and jitter that is actually delivered, and backs off exponentially while the robot doesn't deliver any frames.
+    """
+
+    def __init__(self, fps, window=60, min_backoff=0.1, max_backoff=5.0):
+        """
+        :param fps: frame rate of the camera subscription
+        :param window: number of recent frames the fps and jitter are computed over
+        :param min_backoff: seconds to wait after the first failed fetch, doubled for every further one
+        :param max_backoff: max seconds between two fetch attempts while failing
+        """
+        self.interval = 1.0 / fps
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.next_due = timer()
+        self.deliveries = deque(maxlen=window)
+        self.backoff = 0.0
+        self.failures = 0
+
+    def wait_until_due(self):
+        now = timer()
+        if self.next_due > now:
+            time.sleep(self.next_due - now)
+
+        # schedule relative to the plan, so small delays don't add up. If we fell behind by more than a frame, we
+        # don't try to catch up with a burst of fetches
+        self.next_due += self.interval
+        now = timer()
+        if self.next_due < now - self.interval:
+            self.next_due = now
+
+    def delivered(self):
+        self.deliveries.append(timer())
+        self.backoff = 0.0
+
+    def failed(self):
+        self.failures += 1
+        self.backoff = min(self.max_backoff, self.backoff * 2 or self.min_backoff)
+        time.sleep(self.backoff)
+        self.next_due = timer()
+
+    def stats(self):
+        deliveries = list(self.deliveries)
+        intervals = [later - earlier for earlier, later in zip(deliveries, deliveries[1:])]
+
+        fps = 0.0
+        jitter = 0.0
+        if intervals:
+            mean = sum(intervals) / len(intervals)
+            fps = 1.0 / mean if mean > 0 else 0.0
+            jitter = math.sqrt(sum((interval - mean) ** 2 for interval in intervals) / len(intervals))
+
+        return {
+            "target_fps": round(1.0 / self.interval, 2),
+            "fps": round(fps, 2),
+            "jitter_ms": round(jitter * 1000, 2),  # standard deviation of the time between two frames
+            "failures": self.failures,
+            "backoff_s": self.backoff
+        }
+
+
+class FrameBroadcaster(object):
+
+    def __init__(self, video_srv, img_client, fps=30, on_frame=None):
+        """
+        :param video_srv: the ALVideoDevice service
+        :param img_client: name of the subscription as returned by ALVideoDevice.subscribe
+        :param fps: frame rate of the subscription
+        :param on_frame: optional callback, called with (pil image, frame) from the capture thread for every new frame
+        """
+        self.video_srv = video_srv
+        self.img_client = img_client
+        self.fps = fps
+        self.on_frame = on_frame
+
+        self.condition = threading.Condition()
+        self.latest = None
+        self.seq = 0
+        self.epoch = "{:x}".format(int(time.time() * 1000))  # keeps etags unique if the broadcaster is restarted
+        self.wakeups = 0  # bumped to wake up the viewers while there are no new frames
+        self.viewers = 0
+
+        self.pacer = FramePacer(fps)
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="FrameBroadcaster")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()  # wake up all viewers, so that their streams end
+
+    def is_alive(self):
+        return self.running and self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        encoder = JpegEncoder(DEFAULT_QUALITY)  # only used by this thread, reuses its buffer for all frames
+
+        while self.running:
+            self.pacer.wait_until_due()
+            try:
+                alImage = self.video_srv.getImageRemote(self.img_client)
+                if alImage is not None:
+                    pil_img, jpeg_bytes = alImage_to_JPEG(alImage, encoder)
+                    self.publish(pil_img, jpeg_bytes)
+                    self.pacer.delivered()
+            except RuntimeError:
+                # session dropped while the camera tab is open, try again less and less often
+                self.wake_viewers()
+                self.pacer.failed()
+            except Exception:
+                # eg a malformed ALImage, skip it like a failed fetch instead of freezing all viewers
+                log.exception("Capturing a camera frame failed")
+                self.wake_viewers()
+                self.pacer.failed()
+
+    def wake_viewers(self):
+        """
+        Lets the viewers re-send their last frame. Without new frames, that's the only way for them to notice that
+        their client went away, the generator gets closed by the server once a write fails.
+        """
+        with self.condition:
+            self.wakeups += 1
+            self.condition.notify_all()
+
+    def publish(self, pil_img, jpeg_bytes):
+        with self.condition:
+            self.seq += 1
+            frame = Frame(self.seq, jpeg_bytes, "{}-{}".format(self.epoch, self.seq), datetime.now(), pil_img, {})
+            self.latest = frame
+            self.condition.notify_all()
+
+        if self.on_frame is not None:
+            self.on_frame(pil_img, frame)
+
+    def latest_frame(self):
+        return self.latest
+
+    def wait_for_frame(self, last_seq, last_wakeup=None):
+        """
+        Blocks until there is a frame newer than last_seq, the viewers are woken up or the broadcaster is stopped.
+        :param last_seq: seq of the last frame the caller got, 0 if none
+        :param last_wakeup: wakeup counter the caller got with its last frame, None to only wait for new frames
+        :return: tuple of the newest frame (None if there is none yet) and the current wakeup counter
+        """
+        with self.condition:
+            while self.running and (self.latest is None or self.latest.seq <= last_seq) and \
+                    (last_wakeup is None or self.wakeups == last_wakeup):
+                self.condition.wait()
+
+            return self.latest, self.wakeups
+
+    def stats(self):
+        stats = self.pacer.stats()
+        stats["viewers"] = self.viewers
+        stats["frames"] = self.seq
+        return stats
+
+    def rendition(self, frame, width, quality, encoder):
+        """
+        The frame as JPEG in the given size and quality. Every variant is encoded at most once per frame, viewers with
+        the same settings share it.
+        :param frame: the captured frame
+        :param width: target width, at most the captured width
+        :param quality: JPEG quality
+        :param encoder: JpegEncoder of the calling thread
+        :return: the jpeg bytes
+        """
+        full_w, full_h = frame.image.size
+        width = min(width, full_w)
+        if width == full_w and quality == DEFAULT_QUALITY:
+            return frame.jpeg  # what the capture thread encoded anyway
+
+        key = (width, quality)
+        jpeg = frame.renditions.get(key)
+        if jpeg is None:
+            pil_img = frame.image
+            if width != full_w:
+                pil_img = pil_img.resize((width, max(1, full_h * width // full_w)), Image.BILINEAR)
+            jpeg = encoder.encode(pil_img, quality)
+            frame.renditions[key] = jpeg  # worst case two viewers encode the same variant, no need to lock
+
+        return jpeg
+
+    def mjpeg_stream(self, settings=None):
+        """
+        Generator for one viewer of the multipart MJPEG stream.
+        :param settings: ViewerSettings of the viewer, every captured frame in full size if None
+        """
+        settings = settings or ViewerSettings()
+        encoder = JpegEncoder()  # this runs in the thread of the request
+        frame_interval = 1.0 / (settings.fps or self.fps)
+        adaptive = AdaptiveQuality(frame_interval) if settings.adaptive else None
+
+        with self.condition:
+            self.viewers += 1
+
+        # the finally also runs when the server closes the generator because the client went away
+        try:
+            rendition_failed = False
+            last_seq = 0
+            wakeup = self.wakeups
+            next_due = 0.0
+            while True:
+                if settings.fps:
+                    # viewer wants less frames than we capture, skip until it is due again
+                    time.sleep(max(0.0, next_due - timer()))
+
+                frame, wakeup = self.wait_for_frame(last_seq, wakeup)
+                if not self.running:
+                    return
+                if frame is None:
+                    continue
+                is_new = frame.seq > last_seq
+                last_seq = frame.seq
+
+                width_scale, quality_scale = adaptive.current() if adaptive else (1.0, 1.0)
+                width = int((settings.width or frame.image.size[0]) * width_scale)
+                quality = max(1, int(settings.quality * quality_scale))
+                try:
+                    jpeg = self.rendition(frame, width, quality, encoder)
+                except Exception:
+                    # the viewer gets the frame as captured, logged once per viewer
+                    if not rendition_failed:
+                        log.exception("Resizing a camera frame to width %d failed", width)
+                        rendition_failed = True
+                    jpeg = frame.jpeg
+
+                started = timer()
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n\r\n')
+
+                # the yield only returns once the server has written the frame, so this is our send time
+                finished = timer()
+                next_due = started + frame_interval
+                if adaptive and is_new:
+                    age = (datetime.now() - frame.captured_at).total_seconds()
+                    adaptive.update(finished - started, age)
+        finally:
+            with self.condition:
+                self.viewers -= 1
@@ -0,0 +1,121 @@
+"""
+    Compiled view of the YAML config. The file is only parsed again when its mtime changed, the lookups the routes do
+    on every click (colors by title, tablet items with their media type and URLs, the defaults) are computed once per
+    load instead of scanning the raw lists every time.
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+import yaml
+
+from utils import is_video
+from utils import is_image
+from utils import is_external_path
+
+
+# rgb: (red, green, blue) floats as in the config, hex_int: same color as 0xRRGGBB int (what ALLeds.rotateEyes wants)
+Color = namedtuple("Color", ["title", "rgb", "hex_int"])
+
+# media: "website", "video" or "image". tablet_url: what the tablet has to open to show the item,
+# img_src: src of the image for the img_view page
+TabletItem = namedtuple("TabletItem", ["index", "title", "file_name", "media", "tablet_url", "img_src"])
+
+
+class CompiledConfig(object):
+    """
+    One loaded version of the config file. Never modified after it was built, so it can be shared between threads.
+    """
+
+    def __init__(self, raw, flask_home):
+        """
+        :param raw: the config dict as parsed from the YAML file
+        :param flask_home: URL under which the tablet reaches this server, with trailing slash
+        """
+        self.raw = raw
+
+        self.colors_by_title = {}
+        self.default_color = None
+        for color in raw.get("colors") or []:
+            compiled = Color(color["title"], (color["red"], color["green"], color["blue"]),
+                             rgb_to_hex_int(color["red"], color["green"], color["blue"]))
+            self.colors_by_title.setdefault(compiled.title, compiled)  # first one wins for duplicate titles
+            if color.get("is_default"):
+                self.default_color = compiled
+
+        root = raw.get("tablet_root_location", "")
+        self.tablet_items = []
+        self.default_tablet_index = None
+        for index, item in enumerate(raw.get("tablet_items") or []):
+            self.tablet_items.append(compile_tablet_item(index, item, root, flask_home))
+            if "is_default_img" in item.keys() and self.default_tablet_index is None:
+                self.default_tablet_index = index
+
+
+class ConfigModel(object):
+    """
+    Keeps the compiled config of one file up to date.
+    """
+
+    def __init__(self, path, flask_home):
+        self.path = path
+        self.flask_home = flask_home
+
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.compiled = None
+
+    def get(self):
+        """
+        :return: the CompiledConfig of the current file content, parsed again only if the file was edited
+        """
+        self.reload_if_changed()
+        return self.compiled
+
+    def reload_if_changed(self):
+        """
+        :return: whether the file was (re)loaded
+        """
+        mtime = os.path.getmtime(self.path)
+        with self.lock:
+            if self.compiled is not None and mtime == self.mtime:
+                return False
+
+            with open(self.path, "r") as f:
+                raw = yaml.safe_load(f)
+
+            # swap in a complete new version, readers never see a half built one
+            self.compiled = CompiledConfig(raw, self.flask_home)
+            self.mtime = mtime
+            return True
+
+
+def compile_tablet_item(index, item, root, flask_home):
+    file_name = item["file_name"]
+    external = is_external_path(file_name)
+
+    if external and not is_video(file_name) and not is_image(file_name):
+        media = "website"
+        tablet_url = file_name
+    elif is_video(file_name):
+        media = "video"
+        # locally hosted videos are served to the tablet by us
+        tablet_url = file_name if external else flask_home + root + file_name
+    else:
+        media = "image"
+        tablet_url = flask_home + "show_img_page/" + str(index)
+
+    img_src = file_name if external else "/" + root + file_name
+
+    return TabletItem(index, item.get("title"), file_name, media, tablet_url, img_src)
+
+
+def rgb_to_hex_int(red, green, blue):
+    """
+    :return: the color as 0xRRGGBB int, rounded like matplotlib.colors.to_hex does
+    """
+    value = 0
+    for channel in (red, green, blue):
+        value = (value << 8) | int(round(channel * 255))
+    return value
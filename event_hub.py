@@ -0,0 +1,107 @@
+"""
+    Small publish/subscribe hub used to push state changes, touch events and tablet updates to the open frontend tabs
+    (as server-sent events), so that the pages don't have to poll the server every second.
+"""
+
+import threading
+import json
+import Queue
+
+
+# topics only sent to subscribers that ask for them by name, eg the audio levels that come several times a second
+OPT_IN_TOPICS = {"audio"}
+
+
+class Subscription(object):
+    """
+    One subscriber of the hub, typically one open /event_stream connection.
+    Every subscription has its own bounded queue, so one slow client never blocks the publishers or other clients.
+    """
+
+    def __init__(self, maxsize, topics=None, source=None):
+        self.queue = Queue.Queue(maxsize=maxsize)
+        self.topics = topics  # None means all events, except those of the OPT_IN_TOPICS
+        self.source = source  # only events from this source (robot IP), None means events from all sources
+
+        # set when events had to be dropped because the client didn't keep up, the client then has to resync
+        self.overflowed = False
+
+    def wants(self, topic, source=None):
+        """
+        :param topic: topic of the event, usually its name
+        :param source: where the event is from, events without source go to everyone
+        """
+        if self.topics is None:
+            if topic in OPT_IN_TOPICS:
+                return False
+        elif topic not in self.topics:
+            return False
+        return self.source is None or source is None or source == self.source
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """
+        :param timeout: max seconds to wait for the next event
+        :return: (event name, data) tuple, None if nothing was published within the timeout
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+
+class EventHub(object):
+
+    def __init__(self, queue_size=256):
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.subscriptions = set()
+
+    def subscribe(self, topics=None, source=None):
+        """
+        :param topics: collection of event names the subscriber is interested in, None for all events
+        :param source: only get the events of this source, eg the IP of one robot. None for events of all sources
+        :return: the new Subscription
+        """
+        subscription = Subscription(self.queue_size, topics, source)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, event, data, source=None, topic=None):
+        """
+        Hands the event to every subscriber. Never blocks, safe to call from naoqi callback threads.
+        :param event: name of the event, the frontend registers listeners per name
+        :param data: json serializable payload
+        :param source: where the event is from, eg the IP of the robot. None for events that concern everyone
+        :param topic: what subscribers filter on, None for the name of the event. Several events can share a topic
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+
+        for subscription in subscriptions:
+            if subscription.wants(topic if topic is not None else event, source):
+                subscription.put((event, data))
+
+    def subscriber_count(self):
+        with self.lock:
+            return len(self.subscriptions)
+
+
+def sse_message(event, data):
+    """
+    Formats one server-sent event.
+    :param event: name of the event
+    :param data: json serializable payload
+    :return: the string to write on the text/event-stream response
+    """
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
@@ -0,0 +1,205 @@
+"""
+    Background writers for recorded camera frames. The camera stream only hands the already encoded JPEG bytes to a
+    bounded queue, one thread writes them to disk in batches, so that saving never stalls the live feed.
+    FrameWriter saves every frame as its own file, sharded into one subdirectory per day and minute, so long sessions
+    don't end up in one huge folder. SegmentWriter appends the frames to rotating MJPEG segment files instead, with a
+    timestamp index per segment, so that writing is sequential and a frame can be looked up by time in O(log n).
+"""
+
+import os
+import bisect
+import struct
+import time
+
+from background_writer import BackgroundWriter
+
+
+class FrameWriter(BackgroundWriter):
+
+    def __init__(self, save_dir, max_queued=300, batch_size=30):
+        """
+        :param save_dir: root folder for the saved frames
+        :param max_queued: frames waiting to be written, further frames are dropped (and counted) until there is room
+        :param batch_size: max number of frames written in one go
+        """
+        self.save_dir = save_dir
+
+        self.written = 0
+        self.dropped = 0
+        self.created_dirs = set()  # so that we don't have to ask the file system for every frame
+
+        BackgroundWriter.__init__(self, "FrameWriter", max_queued, batch_size)
+
+    def submit(self, captured_at, jpeg_bytes):
+        """
+        Queues one frame for saving, never blocks.
+        :param captured_at: datetime of the frame, determines folder and file name
+        :param jpeg_bytes: the encoded frame
+        :return: False if the frame had to be dropped because the writer doesn't keep up
+        """
+        if self.put((captured_at, jpeg_bytes)):
+            return True
+        self.dropped += 1
+        return False
+
+    def write_batch(self, batch):
+        for captured_at, jpeg_bytes in batch:
+            folder = os.path.join(self.save_dir, captured_at.strftime("%Y.%m.%d"), captured_at.strftime("%H-%M"))
+            if folder not in self.created_dirs:
+                if not os.path.exists(folder):
+                    os.makedirs(folder)
+                self.created_dirs.add(folder)
+
+            filename = captured_at.strftime('%Y.%m.%d-%H:%M:%S.%f')[:-3] + ".jpg"
+            with open(os.path.join(folder, filename), "wb") as f:
+                f.write(jpeg_bytes)
+
+            self.written += 1
+
+    def stats(self):
+        stats = BackgroundWriter.stats(self)
+        stats["written"] = self.written
+        stats["dropped"] = self.dropped
+        return stats
+
+
+# one index record per frame: capture time (unix seconds), offset and length of the JPEG in the segment file
+INDEX_RECORD = struct.Struct("<dQI")
+
+
+class SegmentWriter(FrameWriter):
+    """
+    Appends the frames to segment files in a folder per recording. Each segment is a plain concatenation of JPEGs
+    (a raw MJPEG stream, eg playable with 'ffplay -f mjpeg segment.mjpeg'), next to it an .idx file with one
+    fixed size INDEX_RECORD per frame. Segments are named after the capture time of their first frame.
+    """
+
+    def __init__(self, save_dir, segment_size=256 * 1024 * 1024, max_queued=300, batch_size=30):
+        """
+        :param save_dir: root folder, every recording gets its own subfolder
+        :param segment_size: bytes after which the next segment is started
+        """
+        self.segment_size = segment_size
+        self.session_dir = os.path.join(save_dir, time.strftime("%Y.%m.%d-%H-%M-%S"))
+        self.segment = None
+        self.index = None
+        self.segment_bytes = 0
+        self.segments = 0
+
+        FrameWriter.__init__(self, save_dir, max_queued, batch_size)
+
+    def write_batch(self, batch):
+        for captured_at, jpeg_bytes in batch:
+            if self.segment is None or self.segment_bytes + len(jpeg_bytes) > self.segment_size:
+                self.start_segment(captured_at)
+
+            self.segment.write(jpeg_bytes)
+            self.index.write(INDEX_RECORD.pack(unix_time(captured_at), self.segment_bytes, len(jpeg_bytes)))
+            self.segment_bytes += len(jpeg_bytes)
+            self.written += 1
+
+        if self.segment is not None:
+            # make the batch visible to readers, without syncing after every single frame
+            self.segment.flush()
+            self.index.flush()
+
+    def start_segment(self, captured_at):
+        self.close()
+
+        if not os.path.exists(self.session_dir):
+            os.makedirs(self.session_dir)
+
+        name = segment_name(unix_time(captured_at))
+        self.segment = open(os.path.join(self.session_dir, name + ".mjpeg"), "wb")
+        self.index = open(os.path.join(self.session_dir, name + ".idx"), "wb")
+        self.segment_bytes = 0
+        self.segments += 1
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+            self.index = None
+
+    def stats(self):
+        stats = FrameWriter.stats(self)
+        stats["segments"] = self.segments
+        stats["session_dir"] = self.session_dir
+        return stats
+
+
+class SegmentIndex(object):
+    """
+    Read access to the .idx file of one segment. Records have a fixed size, so we can binary search the file directly,
+    without loading it.
+    """
+
+    def __init__(self, index_path):
+        self.file = open(index_path, "rb")
+        self.file.seek(0, os.SEEK_END)
+        self.length = self.file.tell() // INDEX_RECORD.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        self.file.seek(i * INDEX_RECORD.size)
+        return INDEX_RECORD.unpack(self.file.read(INDEX_RECORD.size))
+
+    def find(self, timestamp):
+        """
+        :param timestamp: unix seconds
+        :return: (timestamp, offset, length) of the last frame captured at or before timestamp, None if there is none
+        """
+        lo, hi = 0, self.length
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid][0] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self[lo - 1] if lo > 0 else None
+
+    def close(self):
+        self.file.close()
+
+
+def find_frame(session_dir, timestamp):
+    """
+    Looks up the frame of a segmented recording that was shown at the given time.
+    :param session_dir: folder of one recording, as reported by SegmentWriter.stats()
+    :param timestamp: unix seconds
+    :return: (capture timestamp, jpeg bytes), None if the recording started after timestamp
+    """
+    names = sorted(f[:-len(".idx")] for f in os.listdir(session_dir) if f.endswith(".idx"))
+
+    # segment names sort like their start times, so the segment is found by bisecting the names
+    pos = bisect.bisect_right(names, segment_name(timestamp))
+    if pos == 0:
+        return None
+    name = names[pos - 1]
+
+    index = SegmentIndex(os.path.join(session_dir, name + ".idx"))
+    try:
+        record = index.find(timestamp)
+    finally:
+        index.close()
+    if record is None:
+        return None
+
+    frame_time, offset, length = record
+    with open(os.path.join(session_dir, name + ".mjpeg"), "rb") as f:
+        f.seek(offset)
+        return frame_time, f.read(length)
+
+
+def segment_name(timestamp):
+    # fixed width, so that sorting the names sorts by time
+    return "segment_{:017.6f}".format(timestamp)
+
+
+def unix_time(captured_at):
+    return time.mktime(captured_at.timetuple()) + captured_at.microsecond / 1e6
@@ -0,0 +1,202 @@
+"""
+    Non-blocking dispatch of long running robot commands (speech, animations, motion). The routes hand the naoqi calls
+    of a command to a job and return its id right away, instead of holding a Flask worker until the robot is done.
+    The calls themselves are issued as qi futures, so a running job can be cancelled via /jobs/<id>/cancel.
+    Jobs are limited per robot service: a few run at the same time, some more may wait, further ones are rejected.
+"""
+
+import threading
+import itertools
+from collections import OrderedDict
+from collections import namedtuple
+from timeit import default_timer as timer
+
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# what a job has to do. service: name of the naoqi service the concurrency limit applies to, run: callable that gets
+# the job and does the naoqi calls via job.call, on_cancel: None or callable that stops the action on the robot
+Command = namedtuple("Command", ["service", "run", "on_cancel"])
+Command.__new__.__defaults__ = (None,)
+
+
+class JobLimitReached(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+
+    def __init__(self, job_id, name, service, run, on_cancel=None):
+        """
+        :param job_id: unique id, returned to the frontend
+        :param name: what the job does, usually the route
+        :param service: name of the naoqi service the concurrency limit applies to
+        :param run: callable, gets the job and does the naoqi calls via job.call. Its return value is the job result
+        :param on_cancel: optional callable to stop the robot action on cancel, eg ALTextToSpeech.stopAll
+        """
+        self.id = job_id
+        self.name = name
+        self.service = service
+        self.run = run
+        self.on_cancel = on_cancel
+
+        self.state = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted_at = timer()
+        self.started_at = None
+        self.finished_at = None
+
+        self.cancel_requested = False
+        self.future = None  # qi future of the call that is currently running
+        self.finished = threading.Event()
+
+    def call(self, service, method, *args):
+        """
+        Does one naoqi call of the job as qi future, so that the job can be cancelled while waiting for it.
+        :param service: the naoqi service object
+        :param method: name of the method
+        :return: the value returned by the robot
+        """
+        if self.cancel_requested:
+            raise JobCancelled()
+
+        self.future = getattr(service, method)(*args, _async=True)
+        try:
+            return self.future.value()
+        except RuntimeError:
+            if self.cancel_requested:
+                raise JobCancelled()
+            raise
+        finally:
+            self.future = None
+
+    def cancel(self):
+        """
+        :return: False if the job had already finished
+        """
+        if self.finished.is_set():
+            return False
+
+        self.cancel_requested = True
+        future = self.future
+        if future is not None:
+            future.cancel()  # not every naoqi method can be cancelled, hence on_cancel
+        if self.on_cancel is not None and self.state == RUNNING:
+            self.on_cancel()
+        return True
+
+    def wait(self, timeout=None):
+        """
+        :return: whether the job has finished
+        """
+        return self.finished.wait(timeout)
+
+    def duration(self):
+        if self.started_at is None:
+            return None
+        return (self.finished_at or timer()) - self.started_at
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "name": self.name,
+            "service": self.service,
+            "state": self.state,
+            "result": self.result,
+            "error": self.error,
+            "queued_for": round((self.started_at or timer()) - self.submitted_at, 3),
+            "duration": round(self.duration(), 3) if self.duration() is not None else None
+        }
+
+
+class JobTracker(object):
+
+    def __init__(self, max_running=2, max_waiting=8, keep=200):
+        """
+        :param max_running: jobs per service that may run at the same time
+        :param max_waiting: jobs per service that may wait for a free slot, submitting more raises JobLimitReached
+        :param keep: number of finished jobs that can still be looked up
+        """
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.keep = keep
+
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = OrderedDict()
+        self.slots = {}  # service name -> semaphore of the running jobs
+        self.pending = {}  # service name -> number of jobs running or waiting
+
+    def submit(self, name, command):
+        """
+        Starts a job in the background.
+        :param name: what the job does, usually the route
+        :param command: the Command to run
+        :return: the Job
+        """
+        service, run, on_cancel = command
+        with self.lock:
+            pending = self.pending.get(service, 0)
+            if pending >= self.max_running + self.max_waiting:
+                raise JobLimitReached("Too many jobs for {}, try again once some of them finished".format(service))
+            self.pending[service] = pending + 1
+            if service not in self.slots:
+                self.slots[service] = threading.Semaphore(self.max_running)
+
+            job = Job(str(next(self.ids)), name, service, run, on_cancel)
+            self.jobs[job.id] = job
+            self.forget_finished()
+
+        thread = threading.Thread(target=self.execute, args=(job,), name="Job-" + job.id)
+        thread.daemon = True
+        thread.start()
+
+        return job
+
+    def execute(self, job):
+        slot = self.slots[job.service]
+        slot.acquire()
+        try:
+            if job.cancel_requested:
+                job.state = CANCELLED
+                return
+
+            job.state = RUNNING
+            job.started_at = timer()
+            job.result = job.run(job)
+            job.state = DONE
+        except JobCancelled:
+            job.state = CANCELLED
+        except Exception as e:
+            # usually a RuntimeError from naoqi, the job is the only place left to report it
+            job.state = CANCELLED if job.cancel_requested else FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = timer()
+            slot.release()
+            with self.lock:
+                self.pending[job.service] -= 1
+            job.finished.set()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def forget_finished(self):
+        # called with the lock held. Oldest jobs first, running ones are skipped
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished.is_set()]
+        for job_id in finished[:max(0, len(self.jobs) - self.keep)]:
+            del self.jobs[job_id]
+
+    def stats(self):
+        with self.lock:
+            return dict((service, count) for service, count in self.pending.items())
@@ -0,0 +1,154 @@
+"""
+    Logging of the server. All loggers of the server hang below "woz4u", eg "woz4u.touch" for the touch callbacks. The
+    handlers only put the records into a bounded queue, one background thread formats and writes them, so logging
+    never blocks the naoqi callback threads or the requests on a slow terminal. Debug messages of the hot paths (audio
+    chunks, touch events) are filtered by level before anything is formatted, so they cost next to nothing when off.
+    Wizard commands additionally go to the "woz4u.audit" logger, written as one JSON object per line to the audit file,
+    for reconstructing what the wizard did in an experiment.
+"""
+
+import os
+import json
+import logging
+import threading
+import Queue
+from logging.handlers import RotatingFileHandler
+
+
+AUDIT_LOGGER = "woz4u.audit"
+
+# attributes every LogRecord has, everything else was passed via extra and goes into the JSON output
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None)).keys()) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one line of JSON with time (unix seconds), level, logger, message and the fields passed with
+    extra={...}.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 4),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text  # formatted by the QueueHandler
+
+        return json.dumps(entry, default=repr)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts the records into a bounded queue without blocking, the QueueListener writes them. Python 2 doesn't have the
+    one of logging.handlers yet. When the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        # format the message now, the arguments might change until the listener gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+
+class QueueListener(object):
+    """
+    Background thread handing the queued records to the actual handlers, each with its own level filter.
+    """
+
+    def __init__(self, queue, handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = threading.Thread(target=self.run, name="LogWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self, timeout=2.0):
+        """
+        Writes what is still queued and ends the thread.
+        """
+        self.queue.put(None)
+        self.thread.join(timeout)
+        for handler in self.handlers:
+            handler.flush()
+
+
+class AuditFilter(logging.Filter):
+
+    def __init__(self, audit=True):
+        logging.Filter.__init__(self)
+        self.audit = audit
+
+    def filter(self, record):
+        # audit records only go to the audit file, everything else only to the console
+        return (record.name == AUDIT_LOGGER) == self.audit
+
+
+def setup_logging(level="INFO", json_console=False, audit_file=None, audit_max_mb=64, queue_size=10000):
+    """
+    Sends all logging of the process through one queue to the console and the audit file. Call once at startup.
+    :param level: level of the console output, eg "DEBUG" to see every touch event and audio chunk
+    :param json_console: whether the console gets JSON lines instead of readable text
+    :param audit_file: path of the JSON audit log of the wizard commands, None for no audit log
+    :param audit_max_mb: size after which the audit log is rotated, 5 old files are kept
+    :param queue_size: records waiting to be written, further records are dropped (and counted)
+    :return: the QueueListener, stop it on shutdown to write what is still queued
+    """
+    console = logging.StreamHandler()
+    console.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    console.addFilter(AuditFilter(audit=False))
+    if json_console:
+        console.setFormatter(JsonFormatter())
+    else:
+        console.setFormatter(logging.Formatter("%(asctime)s.%(msecs)03d %(levelname)-7s %(name)s: %(message)s",
+                                               "%H:%M:%S"))
+    handlers = [console]
+
+    audit = logging.getLogger(AUDIT_LOGGER)
+    if audit_file is not None:
+        if os.path.dirname(audit_file) and not os.path.exists(os.path.dirname(audit_file)):
+            os.makedirs(os.path.dirname(audit_file))
+        audit_handler = RotatingFileHandler(audit_file, maxBytes=int(audit_max_mb * 1024 * 1024), backupCount=5)
+        audit_handler.setLevel(logging.INFO)
+        audit_handler.addFilter(AuditFilter(audit=True))
+        audit_handler.setFormatter(JsonFormatter())
+        handlers.append(audit_handler)
+        audit.setLevel(logging.INFO)
+    else:
+        audit.disabled = True  # nobody reads it, don't even queue the records
+
+    queue = Queue.Queue(maxsize=queue_size)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(queue))
+    # loggers only create records the console (or the audit log) would write
+    root.setLevel(console.level)
+
+    return QueueListener(queue, handlers)
@@ -0,0 +1,248 @@
+"""
+    Counters, gauges and latency histograms of the server, rendered in the Prometheus text format on /metrics.
+    No client library needed, the few metric types we use are implemented here. Updating a metric is a dict lookup and
+    an addition under a lock, cheap enough for every request and every naoqi call.
+    InstrumentedService wraps a naoqi service, so that every call made through it is timed and counted, no matter if
+    it comes from a route, the state poller or the camera broadcaster.
+"""
+
+import bisect
+import threading
+from timeit import default_timer as timer
+
+
+# seconds, from a quick getter on the robot up to a long animation
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        """
+        :param name: name of the metric, eg woz4u_http_requests_in_flight
+        :param help: what it measures, shown by Prometheus
+        :param labelnames: names of the labels, the values are passed as tuple in the same order on every update
+        """
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}  # label values tuple -> value
+
+    def header(self):
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            lines.append("{}{} {}".format(self.name, format_labels(self.labelnames, labels), format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+
+    type = "gauge"
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: upper bounds of the buckets, in increasing order. +Inf is added
+        """
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)  # first bucket with value <= bound, len(buckets) for +Inf
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # counts per bucket, sum, count
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            values = sorted((labels, ([list(state[0])] + state[1:])) for labels, state in self.values.items())
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(self.labelnames, labels, ("le", format_value(bound))), cumulative))
+            label_string = format_labels(self.labelnames, labels)
+            lines.append("{}_sum{} {}".format(self.name, label_string, format_value(total)))
+            lines.append("{}_count{} {}".format(self.name, label_string, count))
+        return lines
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """
+        :param collector: callable returning metrics that are computed when /metrics is requested, eg the frame rate
+        of the camera. Returns a list of fresh Gauge or Counter objects
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """
+        :return: all metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class ServiceMetrics(object):
+    """
+    The metrics of the naoqi calls: latency histogram, errors and calls in flight, by robot, service and method.
+    """
+
+    def __init__(self, registry):
+        self.latency = registry.histogram("woz4u_naoqi_call_duration_seconds",
+                                          "Duration of naoqi service calls, until the result is there for async calls",
+                                          ["robot", "service", "method"])
+        self.errors = registry.counter("woz4u_naoqi_call_errors_total", "naoqi service calls that raised or failed",
+                                       ["robot", "service", "method"])
+        self.in_flight = registry.gauge("woz4u_naoqi_calls_in_flight", "naoqi service calls that haven't returned yet",
+                                        ["robot", "service"])
+
+
+class InstrumentedCall(object):
+    """
+    A method of an InstrumentedService. Calling it times the call, everything else (eg connect of a qi signal) goes to
+    the wrapped attribute.
+    """
+
+    def __init__(self, function, metrics, robot, service, method):
+        self.function = function
+        self.metrics = metrics
+        self.labels = (robot, service, method)
+        self.flight_labels = (robot, service)
+
+    def __call__(self, *args, **kwargs):
+        metrics = self.metrics
+        metrics.in_flight.inc(self.flight_labels)
+        started = timer()
+        try:
+            result = self.function(*args, **kwargs)
+        except Exception:
+            metrics.in_flight.dec(self.flight_labels)
+            metrics.errors.inc(self.labels)
+            metrics.latency.observe(timer() - started, self.labels)
+            raise
+
+        if kwargs.get("_async") and hasattr(result, "addCallback"):
+            # a qi.Future, the call is done when the future is
+            result.addCallback(lambda future: self.finished(started, future.hasError()))
+        else:
+            self.finished(started, False)
+        return result
+
+    def finished(self, started, failed):
+        self.metrics.in_flight.dec(self.flight_labels)
+        if failed:
+            self.metrics.errors.inc(self.labels)
+        self.metrics.latency.observe(timer() - started, self.labels)
+
+    def __getattr__(self, attr):
+        return getattr(self.function, attr)
+
+
+class InstrumentedService(object):
+    """
+    Stands in for a naoqi service and records every call made through it in the ServiceMetrics.
+    """
+
+    def __init__(self, service, metrics, robot, name):
+        """
+        :param service: the naoqi service object
+        :param robot: IP of the robot, for the labels
+        :param name: name of the service global, eg "tts_srv"
+        """
+        self.service = service
+        self.metrics = metrics
+        self.robot = robot
+        self.name = name
+        self.calls = {}  # method name -> InstrumentedCall, so the wrapper is only built once per method
+
+    def __getattr__(self, attr):
+        call = self.calls.get(attr)
+        if call is not None:
+            return call
+
+        value = getattr(self.service, attr)
+        if not callable(value):
+            return value
+        call = self.calls[attr] = InstrumentedCall(value, self.metrics, self.robot, self.name, attr)
+        return call
@@ -0,0 +1,142 @@
+"""
+    Per-robot state of the server, so that one server process can drive several Peppers at the same time.
+    Every connected robot has its own RobotSession (naoqi session and services, state poller, camera, tablet and touch
+    state, jobs), the RobotRegistry maps the robot IPs to them. A request works on the robot that is bound to its
+    thread (see bind_robot), the naoqi service globals of the server are ServiceProxy objects resolving to the
+    services of that robot.
+"""
+
+import threading
+
+from job_tracker import JobTracker
+from touch_store import TouchStore
+from audio_pipeline import AudioFanout
+
+
+_bound = threading.local()
+
+
+class RobotSession(object):
+
+    def __init__(self, ip, port=9559, touches=None, audio_fanout=None):
+        """
+        :param touches: TouchStore for the touches on the tablet, None for one with the default capacity
+        :param audio_fanout: AudioFanout streaming the microphones to the browsers, None for 48kHz mono
+        """
+        self.ip = ip
+        self.port = port
+
+        self.session = None  # the qi.Session
+        self.services = {}  # name of the service global (eg "tts_srv") -> naoqi service object
+        self.state_poller = None
+        self.jobs = JobTracker()  # concurrency limits are per robot, robots don't wait for each other
+
+        # camera tab
+        self.camera_broadcaster = None
+        self.camera_resolution = None  # name of the resolution the broadcaster is subscribed with
+        self.camera_tab_timestamp = 0
+        self.speech_recognition = None  # live audio of the camera tab
+        # outlives the audio module of the camera tab, so /audio_feed listeners stay connected when the tab is reopened
+        self.audio_fanout = audio_fanout if audio_fanout is not None else AudioFanout(48000, 1)
+        self.save_imgs = False
+        self.frame_writer = None
+        self.record_audio = False  # recording on the robot
+        self.audio_recorder = None  # WavRecorder while recording the live audio on the host
+        self.audio_meter = None  # AudioLevelMeter of the live audio, set by the server
+        self.session_recorder = None  # SessionRecorder while the session is recorded
+
+        # helper for knowing what is on the tablet
+        self.tablet_state = {
+            "index": None,
+            "video_or_website": False
+        }
+
+        # touches on the tablet, see the touch callbacks of the server
+        self.touches = touches if touches is not None else TouchStore()
+
+    def is_connected(self):
+        return self.session is not None and self.session.isConnected()
+
+    def bound(self, function):
+        """
+        :return: function that calls the given one with this robot bound to the calling thread. For background threads
+        and naoqi callbacks that do work for this robot.
+        """
+        def call_bound(*args, **kwargs):
+            previous = current_robot()
+            bind_robot(self)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                bind_robot(previous)
+
+        return call_bound
+
+
+class RobotRegistry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()  # only held for the dict operations, never during naoqi calls
+        self.robots = {}
+        self.default_ip = None  # robot of requests that don't name one, the one connected last
+
+    def get(self, ip=None):
+        """
+        :param ip: IP of the robot, None for the default robot
+        :return: the RobotSession, None if there is no such robot
+        """
+        with self.lock:
+            return self.robots.get(ip if ip is not None else self.default_ip)
+
+    def add(self, robot):
+        """
+        Registers the robot, replacing a previous session with the same IP, and makes it the default robot.
+        """
+        with self.lock:
+            self.robots[robot.ip] = robot
+            self.default_ip = robot.ip
+
+    def remove(self, robot):
+        with self.lock:
+            if self.robots.get(robot.ip) is robot:
+                del self.robots[robot.ip]
+            if self.default_ip == robot.ip:
+                self.default_ip = next(iter(self.robots), None)
+
+    def all(self):
+        with self.lock:
+            return list(self.robots.values())
+
+
+class ServiceProxy(object):
+    """
+    Stands in for one naoqi service of the robot bound to the current thread, eg the tts_srv global of the server.
+    Raises NameError when there is no robot or it isn't connected, which is what the routes already handle for a
+    missing session.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def resolve(self):
+        robot = current_robot()
+        if robot is None or self.name not in robot.services:
+            raise NameError("{} is not available, no robot connected".format(self.name))
+        return robot.services[self.name]
+
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+
+def bind_robot(robot):
+    """
+    :param robot: RobotSession the current thread works on from now on, None for no robot
+    """
+    _bound.robot = robot
+
+
+def current_robot():
+    """
+    :return: the RobotSession bound to the current thread, None if there is none
+    """
+    return getattr(_bound, "robot", None)
@@ -6,4 +6,5 @@ export PYTHONPATH=${PYTHONPATH}:$abs_naoqi_path
 export DYLD_LIBRARY_PATH=${DYLD_LIBRARY_PATH}:$abs_naoqi_lib_path
 source $abs_venv_activate_path
 
-python server.py
\ No newline at end of file
+# threaded: worker pool with keep-alive, WOZ4U_SERVER=dev for the Flask development server with reloader
+python server.py --server ${WOZ4U_SERVER:-threaded} --threads ${WOZ4U_THREADS:-64} "$@"
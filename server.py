@@ -1,27 +1,54 @@
 from flask import Flask, render_template, Response, url_for, request, send_file, abort, send_from_directory, jsonify, \
-    json
+    json, g
 
-import yaml
-import time
 from datetime import datetime
 import os
-import matplotlib
 from timeit import default_timer as timer
 import jinja2
 import sys
 import signal
+import functools
 
-from utils import alImage_to_PIL
-from utils import PIL_to_JPEG_BYTEARRAY
-from utils import is_video
-from utils import is_image
-from utils import is_external_path
 from utils import is_txt_file
+from utils import wait_for_value
 import socket
 import argparse
+import logging
+import atexit
 
 
 from simple_sound_stream import SpeechRecognitionModule
+from simple_sound_stream import SAMPLE_RATE
+from simple_sound_stream import CHANNELS
+from audio_pipeline import AudioFanout
+from audio_recorder import WavRecorder
+from audio_level import AudioLevelMeter
+from session_recorder import SessionRecorder
+from logging_setup import setup_logging
+from logging_setup import AUDIT_LOGGER
+from metrics import MetricsRegistry
+from metrics import ServiceMetrics
+from metrics import InstrumentedService
+from metrics import Gauge
+from state_poller import RobotStatePoller
+from event_hub import EventHub
+from event_hub import sse_message
+from camera_stream import FrameBroadcaster
+from camera_stream import ViewerSettings
+from camera_stream import RESOLUTIONS
+from frame_writer import FrameWriter
+from frame_writer import SegmentWriter
+from config_model import ConfigModel
+from job_tracker import JobLimitReached
+from job_tracker import Command
+from robot_session import RobotSession
+from robot_session import RobotRegistry
+from robot_session import ServiceProxy
+from robot_session import bind_robot
+from robot_session import current_robot
+from touch_store import TouchStore
+from wsgi_server import SERVER_MODES
+from wsgi_server import run_server
 
 import qi
 import vision_definitions
@@ -30,38 +57,40 @@ from urlparse import unquote
 
 app = Flask(__name__)
 
-QI_SESSION = None
-
-# helper for knowing what is on the tablet
-TABLET_STATE = {
-    "index": None,
-    "video_or_website": False
+log = logging.getLogger("woz4u.server")
+touch_log = logging.getLogger("woz4u.touch")  # every touch event on debug level
+audit_log = logging.getLogger(AUDIT_LOGGER)  # the wizard commands, as JSON lines in the audit file
+
+# all connected robots, the server can drive several at once. Each has its own session, services, camera, tablet and
+# touch state, see robot_session.py. Requests pick the robot via the 'robot' query parameter (its IP), default is the
+# robot connected last
+ROBOTS = RobotRegistry()
+
+# config.yaml, parsed again only when it was edited. read_config() updates config and COMPILED_CONFIG from it
+CONFIG_MODEL = None
+COMPILED_CONFIG = None  # indexed version of config, used by the routes
+
+# pushes state changes, touch events and tablet updates to the open /event_stream connections of the robot they are from
+EVENT_HUB = EventHub()
+HEARTBEAT_INTERVAL = 1.0  # seconds, open event streams get a heartbeat at least this often
+
+# latency of the routes and of the naoqi calls, plus camera and audio counters, on /metrics for Prometheus
+METRICS = MetricsRegistry()
+REQUEST_LATENCY = METRICS.histogram("woz4u_http_request_duration_seconds",
+                                    "Duration of requests until the response is returned, for streams until the "
+                                    "stream starts", ["endpoint", "method", "status"])
+REQUEST_EXCEPTIONS = METRICS.counter("woz4u_http_request_exceptions_total", "Requests that raised an exception",
+                                     ["endpoint"])
+REQUESTS_IN_FLIGHT = METRICS.gauge("woz4u_http_requests_in_flight", "Requests being handled right now")
+NAOQI_METRICS = ServiceMetrics(METRICS)
+
+CAMERA_RESOLUTIONS = {
+    "qqvga": vision_definitions.kQQVGA,  # 160 * 120
+    "qvga": vision_definitions.kQVGA,  # 320 * 240
+    "vga": vision_definitions.kVGA,  # 640 * 480
+    "4vga": vision_definitions.k4VGA,  # 1280 * 960
 }
 
-global camera_tab_closed
-camera_tab_closed = True
-
-global camera_tab_timestamp
-camera_tab_timestamp = 0
-
-global touchdown_hist
-touchdown_hist = []
-
-global touchmove_hist
-touchmove_hist = []
-
-global touchmove_ind
-touchmove_ind = 1
-
-global latest_touchmove_used
-latest_touchmove_used = 0
-
-global SAVE_IMGS
-SAVE_IMGS = False
-
-global RECORD_AUDIO
-RECORD_AUDIO = False
-
 global motion_vector
 motion_vector = [0, 0, 0]
 
@@ -83,14 +112,103 @@ FLASK_PORT = 5000
 FLASK_HOME = "http://" + HOST_IP + ":" + str(FLASK_PORT) + "/"
 
 
+@app.before_request
+def start_request_timer():
+    g.request_started = timer()
+    REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def remember_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def observe_request(exception=None):
+    """
+    Records the duration of every request by endpoint, method and status. Requests to unknown urls are counted under
+    endpoint "none", not one label per url.
+    """
+    started = g.pop("request_started", None)
+    if started is None:
+        return
+    REQUESTS_IN_FLIGHT.dec()
+
+    endpoint = request.endpoint or "none"
+    if exception is not None:
+        REQUEST_EXCEPTIONS.inc((endpoint,))
+    status = str(g.pop("response_status", 500))
+    REQUEST_LATENCY.observe(timer() - started, (endpoint, request.method, status))
+
+
+@app.before_request
+def bind_request_robot():
+    """
+    Every request works on the robot given by the 'robot' query parameter, or on the robot connected last if there is
+    none. The naoqi service globals (tts_srv etc.) resolve to the services of that robot.
+    """
+    bind_robot(ROBOTS.get(request.args.get("robot", type=str) or None))
+
+
+# requests that only read or stream something, they aren't wizard commands and don't go into the audit log and
+# session recordings
+NON_COMMAND_ENDPOINTS = {
+    "static", "index", "querry_states", "event_stream", "alive_test", "camera_tab_keep_alive", "ping_curr_tablet_item",
+    "show_img_page", "serve_audio", "video_feed", "camera_snapshot", "camera_stats", "audio_feed", "audio_level",
+    "audio_stats", "img_save_status", "job_status", "get_touch_data", "tablet_drawer", "session_recording_status",
+    "metrics"
+}
+
+
+@app.before_request
+def record_command():
+    """
+    Writes every wizard command (route and arguments) to the audit log and into the session recording of the robot,
+    if one is running.
+    """
+    robot = current_robot()
+    recorder = robot.session_recorder if robot is not None else None
+    audit = not audit_log.disabled and audit_log.isEnabledFor(logging.INFO)
+    if (recorder is None and not audit) or request.endpoint is None or request.endpoint in NON_COMMAND_ENDPOINTS:
+        return
+
+    args = request.args.to_dict()
+    args.pop("robot", None)
+    body = request.get_json(force=True, silent=True) if request.method == "POST" else None
+    if body is not None:
+        args["body"] = body
+
+    if audit:
+        audit_log.info("command", extra={
+            "route": request.path,
+            "params": args,
+            "robot": robot.ip if robot is not None else None,
+            "client": request.remote_addr
+        })
+    if recorder is not None:
+        recorder.add_command(request.path, args)
+
+
+def require_robot():
+    """
+    :return: the RobotSession of the current request. Raises NameError without a connected robot, like using one of
+    the service globals does
+    """
+    robot = current_robot()
+    if robot is None:
+        raise NameError("No robot connected")
+    return robot
+
+
 @app.route('/')
 def index():
 
     read_config()
 
-    if QI_SESSION is not None and QI_SESSION.isConnected():  # if session already exists, fronted was just reloaded...
-        global ip
-        return render_template("index.html", config=config, reconnect_ip=ip)
+    robot = current_robot()
+    if robot is not None and robot.is_connected():  # if session already exists, fronted was just reloaded...
+        return render_template("index.html", config=config, reconnect_ip=robot.ip)
     else:
         return render_template('index.html', config=config, reconnect_ip="")
 
@@ -98,233 +216,295 @@ def index():
 @app.route("/connect_robot")
 def connect_robot():
     """
-    Connects to robot with given IP.
+    Connects to robot with given IP. Other robots connected to the server stay connected, the new one becomes the
+    default robot for requests that don't name one.
     """
-    global ip
     ip = request.args.get('ip', type=str)
-    global port
-    port = 9559
 
     read_config()  # update the config in case it has been edited in the meantime, nice for developing ^
 
-    global QI_SESSION
+    timings = {}  # seconds spent in the steps of the (dis)connect, returned to the frontend
 
-    if QI_SESSION is not None and QI_SESSION.isConnected():
+    old_robot = ROBOTS.get(ip)
+    if old_robot is not None and old_robot.is_connected():
         # connect btn has been pressed while robot was already connect --> it is the disconnedt btn...
-        del QI_SESSION
-
-        QI_SESSION = qi.Session()  # we make a new sess but don't connect it to anything --> essentially disconnect
-        print("disconnecting interface by terminating session.")
-
-        try:
-            global SpeechRecognition
-            SpeechRecognition.stop()
-            del SpeechRecognition
-        except (RuntimeError, NameError):
-            # when camera tab is not open
-            pass
+        log.info("Disconnecting %s by terminating its session", ip)
+        disconnect_robot(old_robot)
 
         return {
             "status": "disconnected"
         }
 
     else:
-        print "connecting interface to new robot session"
+        log.info("Connecting to robot %s", ip)
 
         # normal connect, we make a new session and connect to it
-        try:
+        connect_started = started = timer()
+        if old_robot is not None:
             # TODO doesn't solve the problem that session might still be trying to connect to invalid IP...
-            print "attempting close and del session"
-            QI_SESSION.close()
-            del QI_SESSION
-            time.sleep(1)
-        except AttributeError:
-            print "close attribute excaption pass..."
-            # if the prev session is still trying to connect...
-            pass
-
-        QI_SESSION = None
-        QI_SESSION = qi.Session()
+            log.info("Closing the previous session of %s", ip)
+            disconnect_robot(old_robot)
+        timings["teardown"] = round(timer() - started, 3)
+
+        robot = RobotSession(ip, touches=TouchStore(capacity=config.get("touch_capacity", 4096),
+                                                    max_strokes=config.get("touch_max_strokes", 256)),
+                             audio_fanout=AudioFanout(SAMPLE_RATE, CHANNELS,
+                                                      max_queued=config.get("audio_feed_queue_size", 8)))
+        robot.audio_meter = AudioLevelMeter(
+            SAMPLE_RATE, on_event=functools.partial(EVENT_HUB.publish, source=robot.ip, topic="audio"),
+            margin_db=config.get("audio_vad_margin_db", 12.0),
+            min_db=config.get("audio_vad_min_db", -50.0),
+            hangover=config.get("audio_vad_hangover", 0.4))
+        bind_robot(robot)  # the service globals resolve to the new robot from now on
+        robot.session = qi.Session()
+        started = timer()
         try:
 
 
-            QI_SESSION.connect(str("tcp://" + str(ip) + ":" + str(port)))
+            robot.session.connect(str("tcp://" + str(robot.ip) + ":" + str(robot.port)))
         except RuntimeError as msg:
-            print("qi session connect error!:")
-            print(msg)
+            log.error("qi session connect error: %s", msg)
 
-            QI_SESSION = None
             raise Exception("Couldn't connect session")
-
-        print "past exception!"
-        get_all_services()
+        timings["session"] = round(timer() - started, 3)
+
+        started = timer()
+        get_all_services(robot)
+        timings["services"] = round(timer() - started, 3)
+        ROBOTS.add(robot)
+
+        robot.state_poller = RobotStatePoller(
+            state_querries(robot),
+            interval=config.get("state_poll_interval", 0.5),
+            max_age=config.get("state_max_age", 3.0),
+            on_change=lambda changed: EVENT_HUB.publish("state", changed, robot.ip)
+        )
+        robot.state_poller.start()
 
         # almemory event subscribers
         # global tts_sub
         # tts_sub = mem_srv.subscriber("ALTextToSpeech/TextStarted")
         # tts_sub.signal.connect(tts_callback)
-        tablet_srv.onTouchDownRatio.connect(touchDown_callback)  # on touch down, aka one "click"
-        tablet_srv.onTouchMove.connect(touchMove_callback)  # finger slides on tablet
-        tablet_srv.onTouchUp.connect(touchUp_callback)
+        # naoqi calls these from its own threads, bound so that they update the state of this robot
+        tablet_srv.onTouchDownRatio.connect(robot.bound(touchDown_callback))  # on touch down, aka one "click"
+        tablet_srv.onTouchMove.connect(robot.bound(touchMove_callback))  # finger slides on tablet
+        tablet_srv.onTouchUp.connect(robot.bound(touchUp_callback))
 
-        global vid_finished_signal
-        vid_finished_signal = tablet_srv.videoFinished
-        vid_finished_signal.connect(onVidEnd)
+        tablet_srv.videoFinished.connect(robot.bound(onVidEnd))
 
-        tts_srv.setVolume(config["volume"])
-        tts_srv.setParameter("pitchShift", config["voice_pitch"])
-        tts_srv.setParameter("speed", config["voice_speed"])
         # tts_srv.say("Connected")
 
-        # iterate over autonomous life configuration and set values...
-        for key in config["autonomous_life_config"].keys():
-            if config["autonomous_life_config"][key] == "":
+        # the robot can apply all of these at the same time, so they are issued as futures and only then waited for
+        started = timer()
+        calls = [
+            (tts_srv, "setVolume", [config["volume"]]),
+            (tts_srv, "setParameter", ["pitchShift", config["voice_pitch"]]),
+            (tts_srv, "setParameter", ["speed", config["voice_speed"]]),
+        ]
+        default_color = COMPILED_CONFIG.default_color
+        if default_color is not None:
+            red, green, blue = default_color.rgb
+            calls.append((led_srv, "fadeRGB", ["FaceLeds", red, green, blue, 0.5]))
+
+        # setting the autonomous state resets the other abilities, so it has to be done before them
+        autonomous_state = config["autonomous_life_config"].get("autonomous_state", "")
+        if autonomous_state != "":
+            al_srv.setState(autonomous_state)
+        timings["autonomous_state"] = round(timer() - started, 3)
+
+        started = timer()
+        for key, value in config["autonomous_life_config"].items():
+            if value == "" or key == "autonomous_state":
                 continue
-            else:
-                if key == "autonomous_state":
-                    al_srv.setState(config["autonomous_life_config"][key])
-                elif key == "tangential_collision":
-                    motion_srv.setTangentialSecurityDistance(config["autonomous_life_config"][key])
-                elif key == "orthogonal_collision":
-                    motion_srv.setOrthogonalSecurityDistance(config["autonomous_life_config"][key])
-                elif key == "blinking":
-                    ab_srv.setEnabled(config["autonomous_life_config"][key])
-                elif key == "engagement_mode":
-                    ba_srv.setEngagementMode(config["autonomous_life_config"][key])
-                elif key == "head_breathing":
-                    motion_srv.setBreathEnabled("Head", config["autonomous_life_config"][key])
-                elif key == "arms_breathing":
-                    motion_srv.setBreathEnabled("Arms", config["autonomous_life_config"][key])
-                elif key == "body_breathing":
-                    motion_srv.setBreathEnabled("Body", config["autonomous_life_config"][key])
-                elif key == "legs_breathing":
-                    motion_srv.setBreathEnabled("Legs", config["autonomous_life_config"][key])
-                elif key == "basic_awareness":
-                    ba_srv.setEnabled(config["autonomous_life_config"][key])
-                elif key == "listening_movement":
-                    lm_srv.setEnabled(config["autonomous_life_config"][key])
-                elif key == "speaking_movement":
-                    sm_srv.setEnabled(config["autonomous_life_config"][key])
+            call = autonomous_life_call(key, value)
+            if call is not None:
+                calls.append(call)
+
+        futures = [getattr(service, method)(*args, _async=True) for service, method, args in calls]
+        for future in futures:
+            future.value()  # raises the RuntimeError of a failed call, like the blocking calls did
+        timings["settings"] = round(timer() - started, 3)
 
         # show default image if given
+        started = timer()
         show_default_img_or_hide()
-
-        for color in config["colors"]:
-            try:
-                if color["is_default"]:
-                    r = color["red"]
-                    g = color["green"]
-                    b = color["blue"]
-
-                    led_srv.fadeRGB("FaceLeds", r, g, b, 0.5)
-
-            except KeyError:  # only one of the elements should have the flag...
-                pass
+        timings["tablet"] = round(timer() - started, 3)
+        timings["total"] = round(timer() - connect_started, 3)
 
         return {
             "status": "ok",
-            "ip": ip,
+            "ip": robot.ip,
+            "timings": timings
         }
 
 
-def tts_callback(value):
-    print("in tts callback")
-    print(value)
-
-
-def onVidEnd():
-    TABLET_STATE["video_or_website"] = False
-    pass
+def disconnect_robot(robot):
+    """
+    Stops everything running for the robot, closes its session and removes it from ROBOTS.
+    """
+    stop_state_poller(robot)
+    stop_camera_broadcaster(robot)
+    stop_audio_stream(robot)
 
+    if robot.frame_writer is not None:
+        robot.frame_writer.stop()  # finishes what is still queued in the background
+        robot.frame_writer = None
+    robot.save_imgs = False
 
-def touchDown_callback(x, y, msg):
-    print(x, y, msg)
-    # we append newest first, so that we can nicely iterate over list and fade color out...
-    global touchdown_hist
-    touchdown_hist.insert(0, (x, y))
-    if len(touchdown_hist) > 5:
-        touchdown_hist = touchdown_hist[:5]
+    if robot.audio_recorder is not None:
+        robot.audio_recorder.stop()
+        robot.audio_recorder = None
 
+    if robot.session_recorder is not None:
+        robot.session_recorder.stop()
+        robot.session_recorder = None
 
-def touchMove_callback(x_offset, y_offset):
-    print("slide: ", touchmove_ind, x_offset, y_offset)
-    # if this is a new "series" of touchmoves, create empty list of at current index
-    global touchmove_hist
-    global latest_touchmove_used
+    ROBOTS.remove(robot)
+    try:
+        robot.session.close()
 
-    if latest_touchmove_used != touchmove_ind:
-        touchmove_hist.append([])
-        latest_touchmove_used = touchmove_ind
+        # continue as soon as the session reports that it is closed, instead of a fixed second
+        wait_for_value(robot.session.isConnected, False, timeout=config.get("confirm_timeout", 1.0))
+    except (AttributeError, RuntimeError):
+        log.debug("Session of %s was already gone", robot.ip)
+        # if the prev session is still trying to connect...
+        pass
+    robot.services = {}
 
-    touchmove_hist[-1].append((x_offset / 1600, y_offset / 1080))
 
+def tts_callback(value):
+    log.debug("TTS callback: %s", value)
 
-def touchUp_callback(x, y):
-    print("Touchup!")
-    global touchmove_ind
-    touchmove_ind += 1
 
-    global touchmove_hist
-    touchmove_hist.append([])  # whenever we have a touchdown event, this might be followed by a finger slide...
+def onVidEnd():
+    current_robot().tablet_state["video_or_website"] = False
+    publish_tablet_state()
 
 
-def get_all_services():
+def publish_tablet_state():
     """
-    Provides global references to all naoqi services used somewhere down the line
+    Pushes the tablet state of the current robot to its open frontend tabs, call whenever the item on the tablet
+    changed.
     """
-    global tts_srv
-    tts_srv = QI_SESSION.service("ALTextToSpeech")
-
-    global al_srv
-    al_srv = QI_SESSION.service("ALAutonomousLife")
+    robot = current_robot()
+    EVENT_HUB.publish("state", {
+        "tablet_state": robot.tablet_state,
+        "timestamp": timer()
+    }, robot.ip)
 
-    global ba_srv
-    ba_srv = QI_SESSION.service("ALBasicAwareness")
 
-    global ab_srv
-    ab_srv = QI_SESSION.service("ALAutonomousBlinking")
+def publish_touch(robot, touch):
+    """
+    Sends a touch event to the open tabs and puts it into the session recording, if one is running.
+    """
+    EVENT_HUB.publish("touch", touch, robot.ip)
 
-    global motion_srv
-    motion_srv = QI_SESSION.service("ALMotion")
+    recorder = robot.session_recorder
+    if recorder is not None:
+        recorder.add_touch(touch)
 
-    global video_srv
-    video_srv = QI_SESSION.service("ALVideoDevice")
 
-    global tablet_srv
-    tablet_srv = QI_SESSION.service("ALTabletService")
+def touchDown_callback(x, y, msg):
+    touch_log.debug("Touch down: %s %s %s", x, y, msg)
+    robot = current_robot()
+    seq = robot.touches.touch_down(x, y)
 
-    global as_srv
-    as_srv = QI_SESSION.service("ALAnimatedSpeech")
+    publish_touch(robot, {"seq": seq, "type": "down", "x": x, "y": y})
 
-    global ap_srv
-    ap_srv = QI_SESSION.service("ALAnimationPlayer")
 
-    global posture_srv
-    posture_srv = QI_SESSION.service("ALRobotPosture")
+def touchMove_callback(x_offset, y_offset):
+    touch_log.debug("Slide: %s %s", x_offset, y_offset)
+    robot = current_robot()
+    # the first move after a touch down starts a new stroke in the store
+    seq = robot.touches.touch_move(x_offset / 1600, y_offset / 1080)
 
-    global ar_srv
-    ar_srv = QI_SESSION.service("ALAudioRecorder")
+    publish_touch(robot, {"seq": seq, "type": "move", "x": x_offset / 1600, "y": y_offset / 1080})
 
-    global ad_srv
-    ad_srv = QI_SESSION.service("ALAudioDevice")
 
-    global fd_srv
-    fd_srv = QI_SESSION.service("ALFaceDetection")
+def touchUp_callback(x, y):
+    touch_log.debug("Touch up")
+    robot = current_robot()
+    seq = robot.touches.touch_up()  # whenever we have a touchdown event, this might be followed by a finger slide...
 
-    global mem_srv
-    mem_srv = QI_SESSION.service("ALMemory")
+    publish_touch(robot, {"seq": seq, "type": "up"})
 
-    global lm_srv
-    lm_srv = QI_SESSION.service("ALListeningMovement")
 
-    global sm_srv
-    sm_srv = QI_SESSION.service("ALSpeakingMovement")
+def stop_state_poller(robot):
+    if robot.state_poller is not None:
+        robot.state_poller.stop()
+        robot.state_poller = None
 
-    global audio_player
-    audio_player = QI_SESSION.service("ALAudioPlayer")
 
-    global led_srv
-    led_srv = QI_SESSION.service("ALLeds")
+def get_all_services(robot):
+    """
+    Gets all naoqi services used somewhere down the line from the session of the robot, the service globals resolve
+    to them while the robot is bound.
+    All services are requested at once and then waited for, instead of one round trip to the robot after the other.
+    Every call made through them is timed for /metrics.
+    """
+    futures = [(name, robot.session.service(service, _async=True)) for name, service in NAOQI_SERVICES]
+
+    for name, future in futures:
+        robot.services[name] = InstrumentedService(future.value(), NAOQI_METRICS, robot.ip, name)
+
+
+# names of the global service references and the naoqi services they are bound to by get_all_services
+NAOQI_SERVICES = [
+    ("tts_srv", "ALTextToSpeech"),
+    ("al_srv", "ALAutonomousLife"),
+    ("ba_srv", "ALBasicAwareness"),
+    ("ab_srv", "ALAutonomousBlinking"),
+    ("motion_srv", "ALMotion"),
+    ("video_srv", "ALVideoDevice"),
+    ("tablet_srv", "ALTabletService"),
+    ("as_srv", "ALAnimatedSpeech"),
+    ("ap_srv", "ALAnimationPlayer"),
+    ("posture_srv", "ALRobotPosture"),
+    ("ar_srv", "ALAudioRecorder"),
+    ("ad_srv", "ALAudioDevice"),
+    ("fd_srv", "ALFaceDetection"),
+    ("mem_srv", "ALMemory"),
+    ("lm_srv", "ALListeningMovement"),
+    ("sm_srv", "ALSpeakingMovement"),
+    ("audio_player", "ALAudioPlayer"),
+    ("led_srv", "ALLeds"),
+]
+
+for name, service in NAOQI_SERVICES:
+    # same as a "global tts_srv", resolving to the service of the robot bound to the thread that uses it
+    globals()[name] = ServiceProxy(name)
+
+
+def autonomous_life_call(key, value):
+    """
+    :param key: key of the autonomous_life_config in the config file, except autonomous_state
+    :param value: the configured value
+    :return: tuple of (service, method name, args) that applies the value, None for unknown keys
+    """
+    if key == "tangential_collision":
+        return motion_srv, "setTangentialSecurityDistance", [value]
+    elif key == "orthogonal_collision":
+        return motion_srv, "setOrthogonalSecurityDistance", [value]
+    elif key == "blinking":
+        return ab_srv, "setEnabled", [value]
+    elif key == "engagement_mode":
+        return ba_srv, "setEngagementMode", [value]
+    elif key == "head_breathing":
+        return motion_srv, "setBreathEnabled", ["Head", value]
+    elif key == "arms_breathing":
+        return motion_srv, "setBreathEnabled", ["Arms", value]
+    elif key == "body_breathing":
+        return motion_srv, "setBreathEnabled", ["Body", value]
+    elif key == "legs_breathing":
+        return motion_srv, "setBreathEnabled", ["Legs", value]
+    elif key == "basic_awareness":
+        return ba_srv, "setEnabled", [value]
+    elif key == "listening_movement":
+        return lm_srv, "setEnabled", [value]
+    elif key == "speaking_movement":
+        return sm_srv, "setEnabled", [value]
+
+    return None
 
 
 @app.route("/querry_states")
@@ -335,49 +515,161 @@ def querry_states():
     @return: A dict with ids from the frontend, with the value being what that element should represent
     """
     try:
-        # see if audio transmission is running even though camera tab is closed...
-        try:
-            now = timer()
+        check_camera_tab_alive()
+        return collect_states()
 
-            # this should be obsolete now, camera calls close method when closed... but having this here doesn't hurt,
-            # so leaving it, just in case
-            if now - camera_tab_timestamp > 3:  # if now keep alive ping within 5 seconds...
-                if SpeechRecognition.isStarted:
-                    print("Handling close camera tab!")
-                    SpeechRecognition.stop()  # stop the audio transmission
+    except (NameError, RuntimeError):
+        return {"STATE_QUERRY_ERR": "SESSION NOT AVAILABLE"}
 
-                    # remove camera stream subscriber from video service
-                    if video_srv.getSubscribers():
-                        for subscriber in video_srv.getSubscribers():
-                            if "CameraStream" in subscriber:  # name passed as argument on subscription
-                                video_srv.unsubscribe(subscriber)
 
-        except NameError:
-            pass  # if SpeechRecognition module has never been started and doesn't exist...
+def collect_states(include_robot_states=True):
+    """
+    Assembles the state dict for the frontend. The actual robot states come from the snapshot of the background
+    poller, so this doesn't make any naoqi calls.
+    :param include_robot_states: if False, only the bookkeeping fields (tablet state, timestamps) are returned
+    :return: A dict with ids from the frontend, with the value being what that element should represent
+    """
+    robot = require_robot()
+    if robot.state_poller is None or not robot.state_poller.is_fresh():
+        raise RuntimeError("no recent state snapshot")
 
-        return {
-            "#autonomous_states": al_srv.getState(),
-            "#tangential_collision": round(motion_srv.getTangentialSecurityDistance(), 3) * 100,  # convert form m to
-            "#orthogonal_collision": round(motion_srv.getOrthogonalSecurityDistance(), 3) * 100,  # cm for frontend
-            "#toggle_btn_blinking": ab_srv.isEnabled(),
-            "#toggle_btn_basic_awareness": ba_srv.isEnabled(),
-            "#engagement_states": ba_srv.getEngagementMode(),
-            "#toggle_btn_head_breathing": motion_srv.getBreathEnabled("Head"),
-            "#toggle_btn_body_breathing": motion_srv.getBreathEnabled("Body"),
-            "#toggle_btn_arms_breathing": motion_srv.getBreathEnabled("Arms"),
-            "#toggle_btn_legs_breathing": motion_srv.getBreathEnabled("Legs"),
-            "#volume_slider": tts_srv.getVolume(),
-            "#voice_speed_input": tts_srv.getParameter("speed"),
-            "#voice_pitch_input": tts_srv.getParameter("pitchShift"),
-            "#motion_vector": [round(vel, 1) for vel in motion_srv.getRobotVelocity()],
-            "#toggle_btn_listening": lm_srv.isEnabled(),
-            "#toggle_btn_speaking": sm_srv.isEnabled(),
-            "tablet_state": TABLET_STATE,
-            "#querried_color": get_eye_colors(),
-            "timestamp": timer()
-        }
+    version, age, states = robot.state_poller.snapshot()
+    if not include_robot_states:
+        states = {}
+
+    states["tablet_state"] = robot.tablet_state
+    states["timestamp"] = timer()
+    states["state_version"] = version
+    states["state_age"] = round(age, 3)  # seconds since the robot was last querried
+
+    return states
+
+
+def check_camera_tab_alive():
+    """
+    See if audio transmission is running even though camera tab is closed...
+    """
+    robot = current_robot()
+    if robot is None or robot.speech_recognition is None:
+        return  # if SpeechRecognition module has never been started and doesn't exist...
+
+    try:
+        now = timer()
+
+        # this should be obsolete now, camera calls close method when closed... but having this here doesn't hurt,
+        # so leaving it, just in case
+        if now - robot.camera_tab_timestamp > 3:  # if now keep alive ping within 5 seconds...
+            if robot.speech_recognition.isStarted:
+                log.info("Handling close camera tab of %s", robot.ip)
+                robot.speech_recognition.stop()  # stop the audio transmission
+
+                # remove camera stream subscriber from video service
+                unsubscribe_camera(robot)
+
+    except NameError:
+        pass  # robot got disconnected in the meantime
+
+
+@app.route("/event_stream")
+def event_stream():
+    """
+    Server-sent event stream replacing the periodic polling of the frontend pages. Pushes changed robot states, touch
+    events and tablet updates of the robot of the request as they happen, plus a heartbeat every HEARTBEAT_INTERVAL.
+    While the stream is open, it also acts as keep alive for the camera tab and the image on the tablet.
+    Pass a comma separated list as 'topics' to only get some of the events (eg "touch"), heartbeats are always sent.
+    The "voice" and "audio_level" events of the live audio come several times a second, they are only sent with topic
+    "audio" in the list.
+    """
+    camera_tab = request.args.get("camera_tab", default=0, type=int)
+    tablet_index = request.args.get("tablet_index", type=str)
+
+    topics = request.args.get("topics", type=str)
+    if topics is not None:
+        topics = set(topic for topic in topics.split(",") if topic)
+
+    return Response(
+        event_stream_generator(current_robot(), camera_tab, tablet_index, topics),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"})
+
+
+def event_stream_generator(robot, camera_tab=False, tablet_index=None, topics=None):
+    bind_robot(robot)  # the stream is sent after the route returned, so bind the robot again
+    subscription = EVENT_HUB.subscribe(topics, source=robot.ip if robot is not None else None)
+    try:
+        yield "retry: 2000\n\n"  # how long the browser waits before reconnecting a dropped stream
+
+        if subscription.wants("state"):
+            # send everything once, from then on only the changes
+            yield sse_message("state", heartbeat_states(include_robot_states=True))
+
+        next_heartbeat = timer()
+        while True:
+            event = subscription.get(timeout=max(0.0, next_heartbeat - timer()))
+
+            if subscription.overflowed:
+                # client didn't keep up and we dropped events, it has to fetch everything again
+                subscription.overflowed = False
+                yield sse_message("resync", {})
+
+            if event is not None:
+                yield sse_message(*event)
+
+            if timer() >= next_heartbeat:
+                next_heartbeat = timer() + HEARTBEAT_INTERVAL
+
+                if camera_tab and robot is not None:
+                    robot.camera_tab_timestamp = timer()
+                if tablet_index is not None:
+                    tablet_item_alive(tablet_index)
+                check_camera_tab_alive()
+
+                yield sse_message("heartbeat", heartbeat_states())
+
+    finally:
+        # also reached when the client went away, the next write then fails and the generator gets closed
+        EVENT_HUB.unsubscribe(subscription)
+
+
+def heartbeat_states(include_robot_states=False):
+    try:
+        states = collect_states(include_robot_states)
+        states["connected"] = True
     except (NameError, RuntimeError):
-        return {"STATE_QUERRY_ERR": "SESSION NOT AVAILABLE"}
+        states = {
+            "STATE_QUERRY_ERR": "SESSION NOT AVAILABLE",
+            "connected": False
+        }
+    return states
+
+
+def state_querries(robot):
+    """
+    The naoqi getters behind /querry_states, polled in the background by the RobotStatePoller of the robot.
+    @return: list of (frontend id, service, method name, args, transform) tuples
+    """
+    srv = robot.services  # the poller thread has no robot bound, so it gets the services themselves
+    return [
+        ("#autonomous_states", srv["al_srv"], "getState", (), None),
+        ("#tangential_collision", srv["motion_srv"], "getTangentialSecurityDistance", (),
+         lambda dist: round(dist, 3) * 100),  # convert form m to
+        ("#orthogonal_collision", srv["motion_srv"], "getOrthogonalSecurityDistance", (),
+         lambda dist: round(dist, 3) * 100),  # cm for frontend
+        ("#toggle_btn_blinking", srv["ab_srv"], "isEnabled", (), None),
+        ("#toggle_btn_basic_awareness", srv["ba_srv"], "isEnabled", (), None),
+        ("#engagement_states", srv["ba_srv"], "getEngagementMode", (), None),
+        ("#toggle_btn_head_breathing", srv["motion_srv"], "getBreathEnabled", ("Head",), None),
+        ("#toggle_btn_body_breathing", srv["motion_srv"], "getBreathEnabled", ("Body",), None),
+        ("#toggle_btn_arms_breathing", srv["motion_srv"], "getBreathEnabled", ("Arms",), None),
+        ("#toggle_btn_legs_breathing", srv["motion_srv"], "getBreathEnabled", ("Legs",), None),
+        ("#volume_slider", srv["tts_srv"], "getVolume", (), None),
+        ("#voice_speed_input", srv["tts_srv"], "getParameter", ("speed",), None),
+        ("#voice_pitch_input", srv["tts_srv"], "getParameter", ("pitchShift",), None),
+        ("#motion_vector", srv["motion_srv"], "getRobotVelocity", (), lambda vels: [round(vel, 1) for vel in vels]),
+        ("#toggle_btn_listening", srv["lm_srv"], "isEnabled", (), None),
+        ("#toggle_btn_speaking", srv["sm_srv"], "isEnabled", (), None),
+        ("#querried_color", srv["led_srv"], "getIntensity", ("RightFaceLed1",), bgr_to_rgb),
+    ]
 
 
 @app.route("/set_autonomous_state")
@@ -386,7 +678,6 @@ def set_autonomous_state():
     Sets the autunomous state
     """
     state = request.args.get('state', type=str)
-    print(state)
 
     al_srv.setState(state)
 
@@ -402,7 +693,6 @@ def set_engagement_mode():
     Sets the engagement mode
     """
     mode = request.args.get('mode', type=str)
-    print(mode)
 
     ba_srv.setEngagementMode(mode)
 
@@ -416,59 +706,65 @@ def set_engagement_mode():
 def say_text():
     msg = request.args.get('msg', type=str)
 
-    tts_srv.say(msg)
+    job = submit_job("say_text", say_text_command(msg))
 
     return {
         "status": "ok",
-        "msg": msg
+        "msg": msg,
+        "job_id": job.id
     }
 
 
+def say_text_command(msg):
+    return Command("ALTextToSpeech", lambda job: job.call(tts_srv, "say", msg), tts_srv.stopAll)
+
+
 @app.route("/toggle_setting")
 def toggle_setting():
     setting = request.args.get('setting', type=str)
-    print(setting)
 
+    started = timer()
     new_state = None
-    if setting == "blinking":
-        ab_srv.setEnabled(not ab_srv.isEnabled())
-        new_state = ab_srv.isEnabled()
+    confirmed = False
+    confirm_time = 0.0
 
-    elif setting == "head_breathing":
-        motion_srv.setBreathEnabled("Head", not motion_srv.getBreathEnabled("Head"))
-        new_state = motion_srv.getBreathEnabled("Head")
+    accessors = setting_accessors(setting)
+    if accessors is not None:
+        getter, setter = accessors
+        target = not getter()
+        setter(target)
 
-    elif setting == "arms_breathing":
-        motion_srv.setBreathEnabled("Arms", not motion_srv.getBreathEnabled("Arms"))
-        new_state = motion_srv.getBreathEnabled("Arms")
+        # respond as soon as the robot reports the new state, at most after the timeout
+        new_state, confirm_time, confirmed = wait_for_value(getter, target, timeout=config.get("confirm_timeout", 1.0))
 
-    elif setting == "body_breathing":
-        motion_srv.setBreathEnabled("Body", not motion_srv.getBreathEnabled("Body"))
-        new_state = motion_srv.getBreathEnabled("Body")
+    return {
+        "status": "ok",
+        "setting": setting,
+        "new_state": new_state,
+        "confirmed": confirmed,
+        "confirm_time": round(confirm_time, 3),
+        "duration": round(timer() - started, 3)
+    }
 
-    elif setting == "legs_breathing":
-        motion_srv.setBreathEnabled("Legs", not motion_srv.getBreathEnabled("Legs"))
-        new_state = motion_srv.getBreathEnabled("Legs")
 
+def setting_accessors(setting):
+    """
+    :param setting: name of a toggle in the frontend
+    :return: tuple of (getter, setter) of the setting on the robot, None for unknown settings
+    """
+    if setting == "blinking":
+        return ab_srv.isEnabled, ab_srv.setEnabled
     elif setting == "basic_awareness":
-        ba_srv.setEnabled(not ba_srv.isEnabled())
-        new_state = ba_srv.isEnabled()
-
+        return ba_srv.isEnabled, ba_srv.setEnabled
     elif setting == "listening":
-        lm_srv.setEnabled(not lm_srv.isEnabled())
-        new_state = lm_srv.isEnabled()
-
+        return lm_srv.isEnabled, lm_srv.setEnabled
     elif setting == "speaking":
-        sm_srv.setEnabled(not sm_srv.isEnabled())
-        new_state = sm_srv.isEnabled()
+        return sm_srv.isEnabled, sm_srv.setEnabled
+    elif setting in ["head_breathing", "arms_breathing", "body_breathing", "legs_breathing"]:
+        part = setting.split("_")[0].capitalize()  # eg "Head"
+        return lambda: motion_srv.getBreathEnabled(part), lambda enabled: motion_srv.setBreathEnabled(part, enabled)
 
-    time.sleep(1)
-
-    return {
-        "status": "ok",
-        "setting": setting,
-        "new_state": new_state
-    }
+    return None
 
 
 def show_default_img_or_hide():
@@ -476,19 +772,22 @@ def show_default_img_or_hide():
     Depending on whether a default image is given in the config, either shows that or resets the tablet to the default
     animation gif.
     """
-    for enum_index, item in enumerate(config["tablet_items"]):
-        if "is_default_img" in item.keys():
-            url = FLASK_HOME + "show_img_page/" + str(enum_index)
-            TABLET_STATE["index"] = enum_index
+    tablet_state = require_robot().tablet_state
+    enum_index = COMPILED_CONFIG.default_tablet_index
+    if enum_index is not None:
+        url = robot_page_url(FLASK_HOME + "show_img_page/" + str(enum_index))
+        tablet_state["index"] = enum_index
 
-            tablet_srv.showWebview(url)
+        tablet_srv.showWebview(url)
+        publish_tablet_state()
 
-            return {
-                "showing": "default image"
-            }
+        return {
+            "showing": "default image"
+        }
 
     tablet_srv.hideWebview()
-    TABLET_STATE["index"] = None
+    tablet_state["index"] = None
+    publish_tablet_state()
 
     return {
         "showing": "Pepper default gif, no default image found in config",
@@ -497,16 +796,12 @@ def show_default_img_or_hide():
 
 @app.route("/serve_audio/<path:filename>")
 def serve_audio(filename):
-    print(filename)
     return send_from_directory(config["audio_root_location"], filename)
 
 
 @app.route("/play_audio")
 def play_audio():
     index = request.args.get('index', type=int)
-    print(index)
-
-    print("playing sound")
 
     location = config["audio_files"][index]["location"]
 
@@ -540,62 +835,72 @@ def stop_sound_play():
 
 @app.route("/show_tablet_item/<index>")
 def show_tablet_item(index):
-    item = config["tablet_items"][int(index)]["file_name"]
+    # media type and url are already resolved when the config is loaded
+    item = COMPILED_CONFIG.tablet_items[int(index)]
+    tablet_state = require_robot().tablet_state
 
-    if is_external_path(item) and not is_video(item) and not is_image(item):
+    if item.media == "website":
         # tablet item is external website
         tablet_srv.enableWifi()
-        tablet_srv.showWebview(item)
-        TABLET_STATE["video_or_website"] = True
-
-    elif is_video(item):
-        if is_external_path(item):
-            # externally hosted video
-            video_src = item
-        else:
-            # video hosted locally, prepare "external" path foir tablet
-            video_src = FLASK_HOME + config["tablet_root_location"] + item
+        tablet_srv.showWebview(item.tablet_url)
+        tablet_state["video_or_website"] = True
 
+    elif item.media == "video":
+        # locally hosted videos have their "external" path for the tablet already
         tablet_srv.enableWifi()
-        tablet_srv.playVideo(video_src)
-        TABLET_STATE["video_or_website"] = True
+        tablet_srv.playVideo(item.tablet_url)
+        tablet_state["video_or_website"] = True
 
     else:
-        tablet_srv.showWebview(FLASK_HOME + "show_img_page/" + index)
+        # the image page pings back to the server, so it has to know which robot it is shown on
+        tablet_srv.showWebview(robot_page_url(item.tablet_url))
 
-        TABLET_STATE["video_or_website"] = False
+        tablet_state["video_or_website"] = False
 
-    TABLET_STATE["index"] = index
+    tablet_state["index"] = index
+    publish_tablet_state()
 
     return {
         "status": "ok",
-        "item": item
+        "item": item.file_name
     }
 
 
-def get_tablet_img_from_index(index):
-    img_obj = config["tablet_items"][int(index)]
-    img_src = ""
+def tablet_item_command(index):
+    COMPILED_CONFIG.tablet_items[int(index)]  # IndexError for batches with an invalid index
 
-    if is_external_path(img_obj["file_name"]):
-        # if its externally hosted we don't have to do anything
-        img_src = img_obj["file_name"]
-    else:
-        img_src = "/" + config["tablet_root_location"] + img_obj["file_name"]
+    return Command("ALTabletService", lambda job: show_tablet_item(str(index)))
+
+
+def robot_page_url(url):
+    """
+    :param url: url of one of our pages
+    :return: the url with the current robot as 'robot' parameter, so that the page talks about the right robot
+    """
+    return url + ("&" if "?" in url else "?") + "robot=" + require_robot().ip
+
+
+def robot_ip_or_empty():
+    # for the templates, their requests pass it on as 'robot' parameter
+    robot = current_robot()
+    return robot.ip if robot is not None else ""
 
-    return img_src
+
+def get_tablet_img_from_index(index):
+    # externally hosted images are used as they are, local ones relative to the tablet root
+    return COMPILED_CONFIG.tablet_items[int(index)].img_src
 
 
 @app.route("/show_img_page/<index>")
 def show_img_page(index):
     img_src = get_tablet_img_from_index(index)
-    return render_template("img_view.html", src=img_src, img_index=index)
+    return render_template("img_view.html", src=img_src, img_index=index, robot_ip=robot_ip_or_empty())
 
 
 @app.route("/clear_tablet")
 def clear_tablet():
     tablet_srv.hideWebview()
-    TABLET_STATE["index"] = None
+    require_robot().tablet_state["index"] = None
 
     status = show_default_img_or_hide()
     status["msg"] = "cleaned tablet webview"
@@ -607,22 +912,38 @@ def clear_tablet():
 def ping_curr_tablet_item():
     index = request.args.get('index', type=str)
 
-    if not TABLET_STATE["video_or_website"]:
-        TABLET_STATE["last_ping"] = timer()
-        TABLET_STATE["index"] = index
-
+    if tablet_item_alive(index):
         return {
             "set cur_tab_item": index
         }
 
     else:
-        print("Got image tab ping, but ignored it because website or video is currently on tablet...")
+        log.debug("Ignored image tab ping, website or video is on the tablet or the page isn't the current one")
 
         return {
             "ignered ping for cur_tab_item": index
         }
 
 
+def tablet_item_alive(index):
+    """
+    Keep alive of the image page shown on the tablet, either from its ping or its open event stream.
+    Only the page of the current item counts, a page the wizard already navigated away from may still ping for a
+    moment and must not bring its item back.
+    :param index: index of the tablet item shown on the page
+    :return: False if the ping was ignored because a website or video is on the tablet, or it is from an old page
+    """
+    robot = current_robot()
+    if robot is None or robot.tablet_state["video_or_website"]:
+        return False
+
+    current = robot.tablet_state["index"]
+    if current is None or str(current) != str(index):
+        return False
+
+    robot.tablet_state["last_ping"] = timer()
+    return True
+
 
 
 @app.route("/adjust_volume")
@@ -655,63 +976,74 @@ def stop_tts():
 @app.route("/exec_anim_speech")
 def exec_anim_speech():
     index = request.args.get('index', type=int)
-    print(index)
 
+    annotated_text = get_annotated_text(index)
+
+    job = submit_job("exec_anim_speech", anim_speech_command(annotated_text))
+
+    return {
+        "status": "ok",
+        "annotated_text": annotated_text,
+        "job_id": job.id
+    }
+
+
+def get_annotated_text(index):
     annotated_text = config["animated_speech"][index]["string"]
 
     if is_txt_file(annotated_text):
         with open(annotated_text, "r") as f:
             annotated_text = f.read()
 
-    as_srv.say(annotated_text)
+    return annotated_text
 
-    return {
-        "status": "ok",
-        "annotated_text": annotated_text
-    }
+
+def anim_speech_command(annotated_text):
+    # animated speech talks via ALTextToSpeech, so stopping that cancels it
+    return Command("ALAnimatedSpeech", lambda job: job.call(as_srv, "say", annotated_text), tts_srv.stopAll)
 
 
 @app.route("/exec_gesture")
 def exec_gesture():
     index = request.args.get('index', type=int)
-    print(index)
 
     gesture = config["gestures"][index]["gesture"]
 
-    ap_srv.run(gesture)
+    job = submit_job("exec_gesture", gesture_command(gesture))
 
     return {
         "status": "ok",
-        "gesture": gesture
+        "gesture": gesture,
+        "job_id": job.id
     }
 
 
 @app.route("/exec_custom_gesture")
 def exec_custom_gesture():
     string = request.args.get("string", type=str)
-    print(string)
 
     gesture = unquote(string)
-    print(gesture)
 
-    ap_srv.run(gesture)
+    job = submit_job("exec_custom_gesture", gesture_command(gesture))
 
     return {
         "status": "ok",
-        "gesture": gesture
+        "gesture": gesture,
+        "job_id": job.id
     }
 
 
+def gesture_command(gesture):
+    return Command("ALAnimationPlayer", lambda job: job.call(ap_srv, "run", gesture))
+
+
 @app.route("/set_tts_param")
 def set_tts_param():
     param = request.args.get("param", type=str)
     value = request.args.get("value", type=float)
 
-    print(value)
-
     if param == "pitchShift":
         value = value / 100.0  # for pitch shift we need to adjust the range... nice consistency in the naoqi api >.<
-        print(value)
         tts_srv.setParameter(param, value)
     else:
         tts_srv.setParameter(param, value)
@@ -727,18 +1059,25 @@ def set_tts_param():
 def set_collision_radius():
     param = request.args.get("param", type=str)
     value = request.args.get("value", type=float)
-    print(param)
-    print(value)
 
-    time.sleep(1)
+    started = timer()
 
     # get function dynamically from service object
-    call = motion_srv.__getattribute__("set" + param + "SecurityDistance")
+    call = getattr(motion_srv, "set" + param + "SecurityDistance")
     call(value)
 
+    # the robot reports the distance back as float, so it only has to be close to ours
+    getter = getattr(motion_srv, "get" + param + "SecurityDistance")
+    new_value, confirm_time, confirmed = wait_for_value(getter, value, timeout=config.get("confirm_timeout", 1.0),
+                                                        tolerance=0.01)
+
     return {
         "param": param,
-        "value": value
+        "value": value,
+        "new_value": new_value,
+        "confirmed": confirmed,
+        "confirm_time": round(confirm_time, 3),
+        "duration": round(timer() - started, 3)
     }
 
 
@@ -748,20 +1087,24 @@ def move_to():
     y = request.args.get("y", type=float)
     theta = request.args.get("theta", type=float)
 
-    # Wake up robot
-    # motion_service.wakeUp()
+    def run(job):
+        # Wake up robot
+        # motion_service.wakeUp()
 
-    # Send robot to Pose Init
-    posture_srv.goToPosture("StandInit", 0.5)
+        # Send robot to Pose Init
+        job.call(posture_srv, "goToPosture", "StandInit", 0.5)
 
-    # set velocity
-    motion_srv.moveTo(x, y, theta)
+        # set velocity
+        job.call(motion_srv, "moveTo", x, y, theta)
+
+    job = submit_job("move_to", Command("ALMotion", run, motion_srv.stopMove))
 
     return {
         "call": "move_to",
         "x": x,
         "y": y,
-        "theta": theta
+        "theta": theta,
+        "job_id": job.id
     }
 
 
@@ -794,10 +1137,12 @@ def resting_position():
 
 @app.route("/netural_stand_position")
 def netural_stand_position():
-    posture_srv.goToPosture("Stand", 0.5)
+    job = submit_job("netural_stand_position", Command(
+        "ALRobotPosture", lambda job: job.call(posture_srv, "goToPosture", "Stand", 0.5), posture_srv.stopMove))
 
     return {
-        "status": "entering 'Stand' posture"
+        "status": "entering 'Stand' posture",
+        "job_id": job.id
     }
 
 
@@ -809,17 +1154,21 @@ def move_joint():
     stiffness = 0.5
     time = 1
 
-    if not motion_srv.robotIsWakeUp():
-        motion_srv.wakeUp()
+    def run(job):
+        if not motion_srv.robotIsWakeUp():
+            job.call(motion_srv, "wakeUp")
 
-    motion_srv.setStiffnesses("Head", stiffness)
+        motion_srv.setStiffnesses("Head", stiffness)
 
-    motion_srv.angleInterpolation(
-        [str(axis)],  # which axis
-        [float(val)],  # amount of  movement
-        [int(time)],  # time for movement
-        False  # in absolute angles
-    )
+        job.call(
+            motion_srv, "angleInterpolation",
+            [str(axis)],  # which axis
+            [float(val)],  # amount of  movement
+            [int(time)],  # time for movement
+            False  # in absolute angles
+        )
+
+    job = submit_job("move_joint", Command("ALMotion", run))
 
     if "Head" in axis:
         status = "moving head"
@@ -831,160 +1180,361 @@ def move_joint():
         "axis": axis,
         "val": val,
         "time": time,
-        "stiffness": stiffness
+        "stiffness": stiffness,
+        "job_id": job.id
     }
 
 
 @app.route("/camera_view")
 def camera_view():
-    # see if there are any old video subscribers...
+    # resolution the camera is subscribed with, viewers can only get this or smaller
+    resolution_name = request.args.get("resolution", default=config.get("camera_resolution", "qvga"), type=str)
+    if resolution_name not in CAMERA_RESOLUTIONS:
+        resolution_name = "qvga"
+    fps = config.get("camera_fps", 30)
+
     try:
-        if video_srv.getSubscribers():
-            for subscriber in video_srv.getSubscribers():
-                if "CameraStream" in subscriber:  # name passed as argument on subscription
-                    video_srv.unsubscribe(subscriber)
+        robot = require_robot()
+        # further camera tabs just become additional viewers of the running broadcaster, unless they explicitly ask
+        # for a different resolution
+        broadcaster = robot.camera_broadcaster
+        if broadcaster is None or not broadcaster.is_alive() or \
+                ("resolution" in request.args and resolution_name != robot.camera_resolution):
+            # see if there are any old video subscribers...
+            unsubscribe_camera(robot)
+
+            resolution = CAMERA_RESOLUTIONS[resolution_name]
+            colorSpace = vision_definitions.kRGBColorSpace
+            robot.img_client = video_srv.subscribe("CameraStream", resolution, colorSpace, fps)
+            robot.camera_resolution = resolution_name
+
+            # the broadcaster thread has no robot bound, so it gets the service itself
+            robot.camera_broadcaster = FrameBroadcaster(robot.services["video_srv"], robot.img_client, fps=fps,
+                                                        on_frame=functools.partial(save_camera_frame, robot))
+            robot.camera_broadcaster.start()
 
     except (NameError, RuntimeError):
         # happens when camera tab is open when there is no server has been restarted?
-        return render_template("camera.html")
-
-
-    resolution = vision_definitions.kQVGA  # 320 * 240
-    colorSpace = vision_definitions.kRGBColorSpace
-    global imgClient
-    imgClient = video_srv.subscribe("CameraStream", resolution, colorSpace, 30)
+        return render_template("camera.html", robot_ip=robot_ip_or_empty())
 
-    global camera_tab_closed
-    camera_tab_closed = False
+    robot.camera_tab_timestamp = timer()
 
-    global camera_tab_timestamp
-    camera_tab_timestamp = timer()
+    # the naoqi module for the audio is registered once per process, so only one robot can stream its microphones
+    for other in ROBOTS.all():
+        if other is not robot:
+            stop_audio_stream(other)
 
-    global SpeechRecognition
-    SpeechRecognition = SpeechRecognitionModule("SpeechRecognition", ip, port)
-    SpeechRecognition.start()
+    # a reload or a further camera tab keeps the running module, a second one would leak its threads and audio
+    # stream and play everything twice
+    if robot.speech_recognition is None or not robot.speech_recognition.isStarted:
+        stop_audio_stream(robot)
+        robot.speech_recognition = SpeechRecognitionModule(
+            "SpeechRecognition", robot.ip, robot.port,
+            retention=config.get("audio_buffer_seconds", 60),
+            max_buffer_bytes=int(config.get("audio_buffer_max_mb", 32) * 1024 * 1024),
+            playback_latency=config.get("audio_playback_latency", 0.1),
+            max_playback_latency=config.get("audio_playback_max_latency", 0.5),
+            livestream=config.get("audio_host_playback", True),
+            consumers=[robot.audio_fanout, functools.partial(record_audio_chunk, robot), robot.audio_meter])
+        robot.speech_recognition.start()
 
-    return render_template("camera.html")
+    return render_template("camera.html", robot_ip=robot.ip)
 
 
 @app.route("/close_camera_tab")
 def close_camera_tab():
     try:
-        global SpeechRecognition
-        SpeechRecognition.stop()
-        del SpeechRecognition
+        robot = require_robot()
+        stop_audio_stream(robot)
 
-        if video_srv.getSubscribers():
-            for subscriber in video_srv.getSubscribers():
-                if "CameraStream" in subscriber:  # name passed as argument on subscription
-                    video_srv.unsubscribe(subscriber)
+        unsubscribe_camera(robot)
 
     except (RuntimeError, NameError):
         # happens when cameratab is closed after naoqi session has been closed.
         pass
 
 
+def stop_audio_stream(robot):
+    if robot.speech_recognition is not None:
+        try:
+            robot.speech_recognition.stop()
+        except RuntimeError:
+            pass  # broker is already gone with the session
+        robot.speech_recognition = None
+
+
+def stop_camera_broadcaster(robot):
+    if robot.camera_broadcaster is not None:
+        robot.camera_broadcaster.stop()  # also ends the streams of all viewers
+        robot.camera_broadcaster = None
+
+
+def unsubscribe_camera(robot):
+    """
+    Stops the frame broadcaster of the robot and removes all our camera stream subscribers from its video service.
+    """
+    stop_camera_broadcaster(robot)
+
+    video = robot.services.get("video_srv")
+    if video is None:
+        raise NameError("video_srv is not available, robot is not connected")
+
+    if video.getSubscribers():
+        for subscriber in video.getSubscribers():
+            if "CameraStream" in subscriber:  # name passed as argument on subscription
+                video.unsubscribe(subscriber)
+
 
 @app.route("/camera_tab_keep_alive")
 def camera_tab_keep_alive():
-    global camera_tab_timestamp
-    camera_tab_timestamp = timer()
+    robot = current_robot()
     connected = False
-    try:
-        if QI_SESSION is not None:
-
-            # print(QI_SESSION.isConnected())
-            # print QI_SESSION.__dict__
-            if QI_SESSION.isConnected():
-                connected = True
-            else:
-                connected = False
-    except NameError:
-        # when QI_SESSION is undefined, happens between connect and reconnect I think
-        pass
+    timestamp = timer()
+    if robot is not None:
+        robot.camera_tab_timestamp = timestamp
+        connected = robot.is_connected()
 
     return {
-        "set keep alive timestamp": camera_tab_timestamp,
+        "set keep alive timestamp": timestamp,
         "connected": connected
     }
 
 
 @app.route("/toggle_audio_mute")
 def mute_audio():
-    global SpeechRecognition
-    if SpeechRecognition.isStarted:
-        SpeechRecognition.stop()
+    speech_recognition = require_robot().speech_recognition
+    if speech_recognition.isStarted:
+        speech_recognition.stop()
     else:
-        SpeechRecognition.start()
+        speech_recognition.start()
 
     return {
-        "audio_running": SpeechRecognition.isStarted
+        "audio_running": speech_recognition.isStarted
+    }
+
+
+def record_audio_chunk(robot, chunk, received_at):
+    """
+    Called by the audio pipeline of the camera tab for every chunk, hands it to the background recorder if recording
+    on the host is toggled on, and to the session recording if one is running.
+    """
+    recorder = robot.audio_recorder
+    if recorder is not None:
+        recorder.submit(chunk)
+
+    session_recorder = robot.session_recorder
+    if session_recorder is not None:
+        session_recorder.add_audio(chunk, received_at)
+
+
+@app.route("/toggle_host_audio_recording")
+def toggle_host_audio_recording():
+    """
+    Records the live audio of the camera tab to .wav files on the host, unlike /record_audio_data which records on
+    Pepper. Needs the camera tab to be open, that is where the audio comes from.
+    """
+    robot = require_robot()
+
+    # every robot records into its own sub folder, so that recordings of several robots don't mix
+    save_dir = os.path.join(config.get("audio_host_save_dir", "record_audio"), robot.ip)
+
+    recorder = robot.audio_recorder
+    if recorder is None:
+        robot.audio_recorder = WavRecorder(
+            save_dir, SAMPLE_RATE, CHANNELS,
+            rotate_seconds=config.get("audio_record_rotate_minutes", 30) * 60.0,
+            rotate_bytes=int(config.get("audio_record_rotate_mb", 512) * 1024 * 1024))
+        stats = robot.audio_recorder.stats()
+    else:
+        # recorder finishes what is still queued in the background
+        robot.audio_recorder = None
+        recorder.stop()
+        stats = recorder.stats()
+
+    return {
+        "now_recording_host_audio": robot.audio_recorder is not None,
+        "save_dir": save_dir,
+        "recorder_stats": stats
+    }
+
+
+@app.route("/audio_feed")
+def audio_feed():
+    """
+    Live audio of the robot's microphones as endless .wav stream (16 bit PCM), for operators that aren't sitting at
+    the server. Plays in an <audio> element. Audio only flows while the camera tab of the robot is open and not muted,
+    until then the stream is silent.
+    """
+    robot = require_robot()
+
+    # every listener gets the same chunks from the shared fanout, no matter how many are listening
+    return Response(
+        robot.audio_fanout.wav_stream(),
+        mimetype="audio/wav",
+        headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/audio_level")
+def audio_level():
+    """
+    Level of the live audio (dB full scale) and whether someone is talking, with the times (unix seconds) speech
+    last started and stopped. The same comes as "audio_level" and "voice" events on the event stream, topic "audio".
+    Computed on the server, works without listening to the audio.
+    """
+    robot = require_robot()
+    speech_recognition = robot.speech_recognition
+    level = robot.audio_meter.snapshot()
+    level["audio_running"] = speech_recognition is not None and speech_recognition.isStarted
+    return level
+
+
+@app.route("/audio_stats")
+def audio_stats():
+    """
+    Counters of the live audio of the camera tab: underruns and overruns of the playback, dropped chunks and the
+    latency from receiving audio from the robot until it is played on the host.
+    """
+    robot = require_robot()
+    speech_recognition = robot.speech_recognition
+    return {
+        "audio_running": speech_recognition is not None and speech_recognition.isStarted,
+        "stats": speech_recognition.stats() if speech_recognition is not None else {},
+        "feed": robot.audio_fanout.stats()
     }
 
 
 
 @app.route("/video_feed")
 def video_feed():
+    """
+    MJPEG stream of the camera. Optional query parameters per viewer:
+    res (qqvga, qvga, vga, 4vga) or width: max frame size, quality: max JPEG quality (1 - 95),
+    fps: max frame rate, adaptive=1: reduce size and quality automatically when the connection can't keep up.
+    """
+    robot = current_robot()
+    broadcaster = robot.camera_broadcaster if robot is not None else None
+    if broadcaster is None:
+        abort(503)  # camera tab hasn't subscribed to the camera (yet)
+
+    res = request.args.get("res", type=str)
+    settings = ViewerSettings(
+        width=RESOLUTIONS[res][0] if res in RESOLUTIONS else request.args.get("width", type=int),
+        quality=request.args.get("quality", default=75, type=int),
+        fps=request.args.get("fps", type=float),
+        adaptive=request.args.get("adaptive", default=0, type=int) == 1
+    )
+
+    # every viewer just gets the frames of the shared broadcaster, no matter how many are watching
     return Response(
-        stream_generator(),
+        broadcaster.mjpeg_stream(settings),
         mimetype='multipart/x-mixed-replace; boundary=frame')
 
 
-def stream_generator():
-    counter = 0
-    while True:
-        # frame = camera.get_frame()
-        global imgClient
-        try:
-            alImage = video_srv.getImageRemote(imgClient)
-            if alImage is not None:
-                pil_img = alImage_to_PIL(alImage)
+@app.route("/camera/snapshot")
+def camera_snapshot():
+    """
+    The latest camera frame as single JPEG. Supports conditional GET via the ETag of the frame (If-None-Match), so
+    pollers only download a frame when there is a new one. No Last-Modified on purpose, its second resolution would
+    hide newer frames.
+    """
+    robot = current_robot()
+    broadcaster = robot.camera_broadcaster if robot is not None else None
+    frame = broadcaster.latest_frame() if broadcaster is not None else None
+    if frame is None:
+        abort(503)
 
-                # TODO: make image smaller? Might greatly decrease latency
+    response = Response(frame.jpeg, mimetype="image/jpeg")
+    response.set_etag(frame.etag)
+    response.cache_control.no_cache = True
 
-                timestamp = datetime.now().strftime('%Y.%m.%d-%H:%M:%S.%f')[:-3]
-                filename = timestamp + ".jpg"
-                save_path = os.path.join(config["camera_save_dir"], filename)
-                if not os.path.exists(config["camera_save_dir"]):
-                    os.makedirs(config["camera_save_dir"])
+    return response.make_conditional(request)
 
-                if SAVE_IMGS:
-                    pil_img.save(save_path, "JPEG")
 
-                jpeg_bytes = PIL_to_JPEG_BYTEARRAY(pil_img)
+@app.route("/camera/stats")
+def camera_stats():
+    """
+    Frame rate and jitter the robot actually delivers, open viewers and failed fetches of the running camera stream.
+    """
+    robot = current_robot()
+    broadcaster = robot.camera_broadcaster if robot is not None else None
+    if broadcaster is None or not broadcaster.is_alive():
+        return {"running": False}
 
-                counter += 1
+    stats = broadcaster.stats()
+    stats["running"] = True
+    return stats
 
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + jpeg_bytes + b'\r\n\r\n')
 
-            time.sleep(0.01)
-        except (RuntimeError, NameError):
-            # when session gets disconnected by camera tab is open
-            pass
+def save_camera_frame(robot, pil_img, frame):
+    """
+    Called by the FrameBroadcaster of the robot for every new frame, hands it to the background writer if recording
+    is toggled on, and to the session recording if one is running. The JPEG the stream encoded anyway is saved, no
+    second encoding.
+    """
+    writer = robot.frame_writer
+    if robot.save_imgs and writer is not None:
+        writer.submit(frame.captured_at, frame.jpeg)
+
+    session_recorder = robot.session_recorder
+    if session_recorder is not None:
+        session_recorder.add_frame(frame.jpeg)
 
 
 @app.route("/toggle_img_save")
 def toggle_img_save():
-    global SAVE_IMGS
-    SAVE_IMGS = not SAVE_IMGS
+    robot = require_robot()
+    robot.save_imgs = not robot.save_imgs
+
+    # every robot records into its own sub folder, so that recordings of several robots don't mix
+    save_dir = os.path.join(config["camera_save_dir"], robot.ip)
+
+    if robot.save_imgs:
+        max_queued = config.get("camera_save_queue_size", 300)
+        if config.get("camera_save_mode", "frames") == "segments":
+            # one folder per recording with rotating MJPEG segments and a timestamp index
+            segment_size = int(config.get("camera_segment_size_mb", 256) * 1024 * 1024)
+            robot.frame_writer = SegmentWriter(save_dir, segment_size=segment_size, max_queued=max_queued)
+        else:
+            robot.frame_writer = FrameWriter(save_dir, max_queued=max_queued)
+        stats = robot.frame_writer.stats()
+    else:
+        # writer finishes what is still queued in the background
+        writer = robot.frame_writer
+        stats = writer.stats() if writer is not None else {}
+        if writer is not None:
+            writer.stop()
+        robot.frame_writer = None
 
     return {
-        "SAVE_IMGS": SAVE_IMGS,
-        "save_dir": config["camera_save_dir"]
+        "SAVE_IMGS": robot.save_imgs,
+        "save_dir": save_dir,
+        "writer_stats": stats
+    }
+
+
+@app.route("/img_save_status")
+def img_save_status():
+    """
+    How many recorded frames are written, still queued or had to be dropped because the disk didn't keep up.
+    """
+    robot = require_robot()
+    writer = robot.frame_writer
+    return {
+        "SAVE_IMGS": robot.save_imgs,
+        "writer_stats": writer.stats() if writer is not None else {}
     }
 
 
 @app.route("/record_audio_data")
 def start_audio_recording():
-    global RECORD_AUDIO
-    RECORD_AUDIO = not RECORD_AUDIO
+    robot = require_robot()
+    robot.record_audio = not robot.record_audio
 
     timestamp = datetime.now().strftime('%Y.%m.%d-%H:%M:%S.%f')[:-3]
     filename = timestamp + ".wav"
     save_path = os.path.join(config["audio_save_dir"], filename)
 
-    if RECORD_AUDIO:
+    if robot.record_audio:
         ad_srv.enableEnergyComputation()
         ar_srv.startMicrophonesRecording(
             save_path,
@@ -997,7 +1547,7 @@ def start_audio_recording():
         ad_srv.disableEnergyComputation()
 
     return {
-        "now_recording_audio": RECORD_AUDIO,
+        "now_recording_audio": robot.record_audio,
         "pepper_save_dir": config["audio_save_dir"],
         "filename": filename
     }
@@ -1008,8 +1558,6 @@ def set_led_intensity():
     group = request.args.get('led_group', type=str)
     intensity = request.args.get('intensity', type=float)
     intensity = intensity / 100.0
-    print(group)
-    print(intensity)
     led_srv.setIntensity(group, intensity)
 
     return {
@@ -1025,21 +1573,29 @@ def set_led_color():
 
     color = request.args.get('color', type=str)
 
-    for color_enum in config["colors"]:
-        if color_enum["title"] == color:
-            r = color_enum["red"]
-            g = color_enum["green"]
-            b = color_enum["blue"]
+    color_enum = COMPILED_CONFIG.colors_by_title.get(color)
+    if color_enum is None:
+        return {
+            "status": "error",
+            "msg": "No color '{}' in the config".format(color)
+        }
 
-            print(r, g, b)
-            print(group)
+    red, green, blue = color_enum.rgb
+    led_srv.fadeRGB(group, red, green, blue, 0.5)
 
-            led_srv.fadeRGB(group, r, g, b, 0.5)
+    return {
+        "staus": "updated led color",
+        "color": color
+    }
 
-            return {
-                "staus": "updated led color",
-                "color": color
-            }
+
+def led_color_command(color):
+    color_enum = COMPILED_CONFIG.colors_by_title.get(color)
+    if color_enum is None:
+        raise ValueError("No color '{}' in the config".format(color))
+
+    red, green, blue = color_enum.rgb
+    return Command("ALLeds", lambda job: job.call(led_srv, "fadeRGB", "FaceLeds", red, green, blue, 0.5))
 
 
 @app.route("/exec_eye_anim")
@@ -1047,102 +1603,333 @@ def exec_eye_anim():
     anim = request.args.get('anim', type=str)
     duration = request.args.get('secs', type=str)
     duration = float(duration)
+    color_enum = COMPILED_CONFIG.colors_by_title.get(request.args.get('color', type=str))
 
-    prev_color = get_eye_colors()
-    # print(prev_color)
-
-    if anim == "randomEyes":
-        led_srv.randomEyes(duration)
-    elif anim == "rasta":
-        led_srv.rasta(duration)
-    elif anim == "rotateEyes":
-        color = request.args.get('color', type=str)
-
-        for color_enum in config["colors"]:
-            if color_enum["title"] == color:
-                final_hex_int = matplotlib.colors.to_hex([color_enum["red"], color_enum["green"], color_enum["blue"]])
-                # print(final_hex_int)
-                final_hex_int = final_hex_int.replace("#", "0x")
-                # print(final_hex_int)
-                final_hex_int = int(final_hex_int, 16)
-                # print(final_hex_int)
+    def run(job):
+        prev_color = get_eye_colors()
+        # print(prev_color)
 
+        try:
+            if anim == "randomEyes":
+                job.call(led_srv, "randomEyes", duration)
+            elif anim == "rasta":
+                job.call(led_srv, "rasta", duration)
+            elif anim == "rotateEyes" and color_enum is not None:
                 round_time = 1.0
-                led_srv.rotateEyes(final_hex_int, round_time, float(duration))
+                job.call(led_srv, "rotateEyes", color_enum.hex_int, round_time, float(duration))
+        finally:
+            # also when cancelled, the eyes shouldn't stay in the animation
+            led_srv.fadeRGB("FaceLeds", prev_color[0], prev_color[1], prev_color[2], 0.5)
 
-    # led_srv.fadeRGB("FaceLeds", 1.0, 1.0, 1.0, 0.5)
-    led_srv.fadeRGB("FaceLeds", prev_color[0], prev_color[1], prev_color[2], 0.5)
+    job = submit_job("exec_eye_anim", Command("ALLeds", run))
 
     return {
         "status": "eye anim",
-        "animation": anim
+        "animation": anim,
+        "job_id": job.id
+    }
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    """
+    State of a background job started by one of the command routes: queued, running, done, failed or cancelled.
+    """
+    job = require_robot().jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    return job.to_dict()
+
+
+@app.route("/jobs/<job_id>/cancel")
+def cancel_job(job_id):
+    """
+    Stops a queued or running job. Speech and motion are stopped on the robot, other naoqi calls are cancelled if
+    naoqi supports it for them.
+    """
+    job = require_robot().jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    cancelled = job.cancel()
+    status = job.to_dict()
+    status["cancelled"] = cancelled
+    return status
+
+
+def submit_job(name, command):
+    """
+    Runs the command as background job of the robot of the request. The job thread gets the robot bound, so the
+    service globals used by the command resolve to that robot.
+    :return: the Job
+    """
+    robot = require_robot()
+    return robot.jobs.submit(name, command._replace(run=robot.bound(command.run)))
+
+
+@app.errorhandler(JobLimitReached)
+def job_limit_reached(e):
+    response = jsonify(status="error", msg=str(e))
+    response.status_code = 429
+    return response
+
+
+# actions that can be used in /batch, build the Command from the params of the action. Raise ValueError, KeyError,
+# IndexError or TypeError for invalid params
+BATCH_ACTIONS = {
+    "set_led_color": lambda params: led_color_command(params["color"]),
+    "show_tablet_item": lambda params: tablet_item_command(params["index"]),
+    "say_text": lambda params: say_text_command(str(params["msg"])),
+    "exec_anim_speech": lambda params: anim_speech_command(get_annotated_text(int(params["index"]))),
+    "exec_gesture": lambda params: gesture_command(config["gestures"][int(params["index"])]["gesture"]),
+    "exec_custom_gesture": lambda params: gesture_command(str(params["string"])),
+}
+
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    """
+    Runs several commands with one request, eg an operator macro that sets the eye color, shows a tablet item, says a
+    line and runs a gesture. Expects a JSON body like
+    {"actions": [{"action": "set_led_color", "params": {"color": "Red"}},
+                 {"action": "say_text", "params": {"msg": "Hello"}, "mode": "parallel"}]}
+    An action with mode "parallel" runs at the same time as the action before it, "after_previous" (the default)
+    waits until all actions before it are done. Once an action failed, the actions after it are skipped.
+    :return: result and timings per action, in the order of the request
+    """
+    body = request.get_json(force=True, silent=True)
+    actions = body.get("actions") if isinstance(body, dict) else None  # a list or number as body is just as invalid
+    if not isinstance(actions, list) or len(actions) == 0:
+        return jsonify(status="error", msg="Expected a JSON body with a non empty list of actions"), 400
+
+    # build all commands first, so that a typo in the last action doesn't leave the macro half executed
+    steps = []  # lists of actions that run at the same time
+    for i, action in enumerate(actions):
+        try:
+            name = action["action"]
+            mode = action.get("mode", "after_previous")
+            if name not in BATCH_ACTIONS:
+                raise ValueError("Unknown action")
+            if mode not in ["parallel", "after_previous"]:
+                raise ValueError("Unknown mode '{}'".format(mode))
+            command = BATCH_ACTIONS[name](action.get("params") or {})
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            return jsonify(status="error", msg="Invalid action {}: {}".format(i, repr(e)), action=action), 400
+
+        if mode == "after_previous" or len(steps) == 0:
+            steps.append([])
+        steps[-1].append((i, name, command))
+
+    started = timer()
+    deadline = started + config.get("batch_timeout", 60.0)
+    results = [None] * len(actions)
+    failed = False
+
+    for step in steps:
+        jobs = []
+        for i, name, command in step:
+            if failed:
+                results[i] = {"action": name, "state": "skipped"}
+                continue
+            try:
+                jobs.append((i, name, submit_job(name, command)))
+            except JobLimitReached as e:
+                results[i] = {"action": name, "state": "rejected", "error": str(e)}
+                failed = True
+
+        for i, name, job in jobs:
+            job.wait(max(0.0, deadline - timer()))
+
+            result = job.to_dict()
+            result["action"] = name
+            result["started_at"] = round(job.started_at - started, 3) if job.started_at is not None else None
+            results[i] = result
+            if job.state != "done":
+                failed = True  # also when it is still running after the timeout
+
+    return {
+        "status": "error" if failed else "ok",
+        "results": results,
+        "duration": round(timer() - started, 3)
     }
 
 
 def get_eye_colors():
     # just return the value of one of the Leds in one of the eyes...
+    return bgr_to_rgb(led_srv.getIntensity("RightFaceLed1"))
+
+
+def bgr_to_rgb(bgr):
     # this is BGR -.- the inconsistency in this API is unreal...
-    bgr = led_srv.getIntensity("RightFaceLed1")
-    rgb = [round(bgr[2], 2), round(bgr[1], 2), round(bgr[0], 2)]
-    return rgb
+    return [round(bgr[2], 2), round(bgr[1], 2), round(bgr[0], 2)]
 
 
 @app.route("/tablet_drawer")
 def tablet_drawer():
-    return render_template('tablet_drawer.html')
+    return render_template('tablet_drawer.html', robot_ip=robot_ip_or_empty())
 
 
 @app.route("/get_touch_data")
 def get_touch_data():
+    """
+    Without parameters: the last touch downs and finger slides, plus the sequence number of the newest touch event.
+    With 'since' (a sequence number): only the touch events after it, in the order they happened. With 'wait' (max
+    TOUCH_MAX_WAIT seconds) the request waits for the next event if there is none yet (long poll). If the events the
+    client is missing are gone (cleared or overwritten), it gets everything again, with "reset": true.
+    """
+    touches = require_robot().touches
+    since = request.args.get("since", type=int)
+    wait = min(request.args.get("wait", default=0.0, type=float), TOUCH_MAX_WAIT)
 
-    global touchmove_hist
-    filtered_touchmove_list = []
-    # this one we must reverse here, because doing this before would be more cumbersome
-    for sequence in reversed(touchmove_hist):
-        if len(sequence) > 2:
-            filtered_touchmove_list.append(sequence)
-
-    if len(filtered_touchmove_list) > 5:
-        filtered_touchmove_list = filtered_touchmove_list[:5]  # we keep the last 5 recent
+    if since is not None:
+        seq, events = touches.events_since(since, wait=wait, limit=TOUCH_MAX_EVENTS)
+        if events is not None:
+            return {
+                "seq": seq,
+                "events": events
+            }
 
+    # the last 5 slides, without the few moves of a tap
+    seq, touchdown_hist, touchmove_hist = touches.snapshot(5, 5, min_points=3)
     return {
-        # we return the list in reverse order, so that we can put a nice fading color gradient on the older items...
+        "seq": seq,
+        "reset": since is not None,
+        # newest first, so that we can put a nice fading color gradient on the older items...
         "touchdown_hist": touchdown_hist,
-        "touchmove_hist": filtered_touchmove_list
+        "touchmove_hist": touchmove_hist
     }
 
 
+TOUCH_MAX_WAIT = 25.0  # seconds a long poll of /get_touch_data waits at most, below the usual proxy timeouts
+TOUCH_MAX_EVENTS = 1000  # events per /get_touch_data response, the client asks again for the rest
+
+
 @app.route("/clear_touch_hist")
 def cleat_touch_hist():
-    global touchmove_hist
-    touchmove_hist = []
+    robot = require_robot()
+    seq = robot.touches.clear()
+
+    publish_touch(robot, {"seq": seq, "type": "clear"})
+
+    return {
+        "state": "reset all touch data to initial values"
+    }
 
-    global touchdown_hist
-    touchdown_hist = []
 
-    global touchmove_ind
-    touchmove_ind = 1
+@app.route("/toggle_session_recording")
+def toggle_session_recording():
+    """
+    Starts or stops recording the session of the robot: wizard commands, tablet touches and, while the camera tab is
+    open, camera frames and audio, all on one timeline. See session_recorder.py for the files and how to read them.
+    """
+    robot = require_robot()
 
-    global latest_touchmove_used
-    latest_touchmove_used = 0
+    # every robot records into its own sub folder, so that recordings of several robots don't mix
+    save_dir = os.path.join(config.get("session_save_dir", "record_sessions"), robot.ip)
+
+    recorder = robot.session_recorder
+    if recorder is None:
+        robot.session_recorder = SessionRecorder(save_dir, SAMPLE_RATE, CHANNELS,
+                                                 max_queued=config.get("session_queue_size", 1024))
+        stats = robot.session_recorder.stats()
+    else:
+        # recorder finishes what is still queued in the background
+        robot.session_recorder = None
+        recorder.stop()
+        stats = recorder.stats()
 
     return {
-        "state": "reset all touch data to initial values"
+        "now_recording_session": robot.session_recorder is not None,
+        "recorder_stats": stats
     }
 
 
+@app.route("/session_recording_status")
+def session_recording_status():
+    robot = require_robot()
+    recorder = robot.session_recorder
+    return {
+        "now_recording_session": recorder is not None,
+        "recorder_stats": recorder.stats() if recorder is not None else {}
+    }
+
+
+def collect_robot_metrics():
+    """
+    Camera and audio gauges of all connected robots, read from their stats when /metrics is requested.
+    """
+    camera_fps = Gauge("woz4u_camera_fps", "Frame rate the robot camera actually delivers", ["robot"])
+    camera_target_fps = Gauge("woz4u_camera_target_fps", "Frame rate the camera stream asks for", ["robot"])
+    camera_failures = Gauge("woz4u_camera_fetch_failures", "Failed frame fetches of the running camera stream",
+                            ["robot"])
+    camera_viewers = Gauge("woz4u_camera_viewers", "Open /video_feed connections", ["robot"])
+    audio_queued = Gauge("woz4u_audio_queue_depth", "Audio chunks waiting for the consumers of the audio pipeline",
+                         ["robot"])
+    audio_dropped = Gauge("woz4u_audio_dropped_chunks", "Audio chunks dropped because the pipeline queue was full",
+                          ["robot"])
+    audio_buffered = Gauge("woz4u_audio_playback_buffered_seconds", "Audio waiting in the jitter buffer of the host "
+                                                                     "playback", ["robot"])
+    audio_underruns = Gauge("woz4u_audio_playback_underruns", "Underruns of the host playback", ["robot"])
+    audio_latency = Gauge("woz4u_audio_playback_latency_seconds", "Smoothed latency from receiving audio until it is "
+                                                                   "played on the host", ["robot"])
+    audio_listeners = Gauge("woz4u_audio_feed_listeners", "Open /audio_feed connections", ["robot"])
+
+    for robot in ROBOTS.all():
+        labels = (robot.ip,)
+        broadcaster = robot.camera_broadcaster
+        if broadcaster is not None and broadcaster.is_alive():
+            stats = broadcaster.stats()
+            camera_fps.set(stats["fps"], labels)
+            camera_target_fps.set(stats["target_fps"], labels)
+            camera_failures.set(stats["failures"], labels)
+            camera_viewers.set(stats["viewers"], labels)
+
+        speech_recognition = robot.speech_recognition
+        if speech_recognition is not None:
+            stats = speech_recognition.stats()
+            audio_queued.set(stats["queued_chunks"], labels)
+            audio_dropped.set(stats["dropped_chunks"], labels)
+            audio_buffered.set(stats["buffered_seconds"], labels)
+            audio_underruns.set(stats["underruns"], labels)
+            if stats["latency"] is not None:
+                audio_latency.set(stats["latency"], labels)
+        audio_listeners.set(robot.audio_fanout.stats()["listeners"], labels)
+
+    return [camera_fps, camera_target_fps, camera_failures, camera_viewers, audio_queued, audio_dropped,
+            audio_buffered, audio_underruns, audio_latency, audio_listeners]
+
+
+METRICS.add_collector(collect_robot_metrics)
+
+
+@app.route("/metrics")
+def metrics():
+    """
+    All metrics of the server in the Prometheus text format: latency histograms of the routes and of the naoqi calls
+    by service and method, errors, requests and calls in flight, camera frame rate and audio queue depth per robot.
+    """
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.route("/alive_test")
 def alive_test():
     return {"status": "server is alive"}
 
 def read_config(verbose=False):
+    """
+    Brings config and COMPILED_CONFIG up to date with the config file. Only a stat call, unless the file was edited.
+    """
     global config
-    with open(CONFIG_FILE, "r") as f:
-        # The FullLoader parameter handles the conversion from YAML
-        # scalar values to Python the dictionary format
-        config = yaml.safe_load(f)
-        if verbose:
-            print(config)
+    global COMPILED_CONFIG
+    global CONFIG_MODEL
+    if CONFIG_MODEL is None:
+        CONFIG_MODEL = ConfigModel(CONFIG_FILE, FLASK_HOME)
+
+    COMPILED_CONFIG = CONFIG_MODEL.get()
+    config = COMPILED_CONFIG.raw
+    if verbose:
+        log.info("Config: %s", config)
 
 
 def pretty_print_shortcut(raw_string):
@@ -1166,6 +1953,19 @@ def pretty_print_shortcut(raw_string):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", dest="config", default="config.yaml", type=str, help="Which YAML configuration file to use. ")
+    parser.add_argument("--server", dest="server", default="dev", choices=SERVER_MODES,
+                        help="dev: Flask development server with debugger and reloader. threaded: pool of worker "
+                             "threads with keep-alive, for running experiments. cheroot: cheroot WSGI server, if it "
+                             "is installed.")
+    parser.add_argument("--threads", dest="threads", default=64, type=int,
+                        help="Worker threads of the threaded and cheroot server. Every open camera or event stream "
+                             "needs one for itself.")
+    parser.add_argument("--timeout", dest="timeout", default=10.0, type=float,
+                        help="Seconds until idle keep-alive connections and stalled clients are closed.")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false",
+                        help="Close the connection after every request (threaded server).")
+    parser.add_argument("--log-level", dest="log_level", default=None, type=str,
+                        help="Overrides log_level of the config, eg DEBUG to see every touch event and audio chunk.")
     args = parser.parse_args()
 
     global CONFIG_FILE
@@ -1173,7 +1973,16 @@ if __name__ == '__main__':
 
     read_config()
 
+    log_listener = setup_logging(
+        level=args.log_level or config.get("log_level", "INFO"),
+        json_console=config.get("log_json", False),
+        audit_file=config.get("log_audit_file", None),
+        audit_max_mb=config.get("log_audit_max_mb", 64),
+        queue_size=config.get("log_queue_size", 10000))
+    atexit.register(log_listener.stop)  # write what is still queued
+
     # register custom filter for jinja2, so that we can use it in the frontend
     jinja2.filters.FILTERS['prettyshortcut'] = pretty_print_shortcut
 
-    app.run(host='0.0.0.0', port=FLASK_PORT, debug=True)
+    run_server(app, args.server, host='0.0.0.0', port=FLASK_PORT, threads=args.threads, timeout=args.timeout,
+               keep_alive=args.keep_alive)
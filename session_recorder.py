@@ -0,0 +1,255 @@
+"""
+    Records everything that happens in a study session on one timeline: the wizard's commands, touches on the tablet,
+    the live audio and the camera frames. Every record gets a timestamp from the same clock (seconds since the start
+    of the session, from the timer() the rest of the server uses too) and is appended to the stream file of its kind,
+    one background thread does all the writing. Next to them, index.bin gets one fixed size INDEX_RECORD per record,
+    so a session can be sliced by time range without reading the streams, see SessionReader.
+
+    Files in the session folder:
+    session.json: when the session started (unix time), audio format and the counters, rewritten when it is stopped
+    events.jsonl: one JSON object per line for the commands and the touches
+    audio.wav: the audio chunks one after the other, the header is patched when the session is stopped
+    camera.mjpeg: the JPEG frames one after the other (a raw MJPEG stream, eg 'ffplay -f mjpeg camera.mjpeg')
+    index.bin: time, stream, offset and length of every record
+"""
+
+import os
+import json
+import time
+import errno
+import struct
+from timeit import default_timer as timer
+
+import numpy as np
+
+from audio_pipeline import wav_header
+from background_writer import BackgroundWriter
+
+
+COMMAND = 0
+TOUCH = 1
+AUDIO = 2
+CAMERA = 3
+
+STREAM_NAMES = {COMMAND: "command", TOUCH: "touch", AUDIO: "audio", CAMERA: "camera"}
+STREAM_FILES = {COMMAND: "events.jsonl", TOUCH: "events.jsonl", AUDIO: "audio.wav", CAMERA: "camera.mjpeg"}
+
+# seconds since the start of the session, stream, offset and length of the record in the stream file
+INDEX_RECORD = struct.Struct("<dBQI")
+INDEX_DTYPE = np.dtype([("t", "<f8"), ("stream", "u1"), ("offset", "<u8"), ("length", "<u4")])
+
+
+def make_session_dir(save_dir, name):
+    """
+    Creates the folder of a new session, with a counter suffix if there already is one of that name (a session
+    restarted within the same second).
+    :return: path of the created folder
+    """
+    suffix = 0
+    while True:
+        path = os.path.join(save_dir, name if suffix == 0 else "{}-{}".format(name, suffix))
+        try:
+            os.makedirs(path)
+            return path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        suffix += 1
+
+
+class SessionRecorder(BackgroundWriter):
+
+    def __init__(self, save_dir, sample_rate, channels, max_queued=1024, batch_size=64):
+        """
+        :param save_dir: root folder, every session gets its own subfolder named after its start
+        :param sample_rate: samples per second and channel of the audio chunks
+        :param channels: number of channels of the audio chunks, chunks with other numbers are skipped
+        :param max_queued: records waiting to be written, further records are dropped (and counted) until there is room
+        :param batch_size: max number of records written in one go
+        """
+        self.started = timer()
+        self.started_at = time.time()
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+        self.session_dir = make_session_dir(save_dir, time.strftime("%Y.%m.%d-%H-%M-%S"))
+        self.files = {}
+        for stream, filename in STREAM_FILES.items():
+            if filename not in self.files:
+                self.files[filename] = open(os.path.join(self.session_dir, filename), "wb")
+        self.audio_header_size = len(wav_header(sample_rate, channels, 0))
+        self.files["audio.wav"].write(wav_header(sample_rate, channels, 0))
+        self.index = open(os.path.join(self.session_dir, "index.bin"), "wb")
+        self.offsets = dict((filename, f.tell()) for filename, f in self.files.items())
+
+        self.written = dict((name, 0) for name in STREAM_NAMES.values())
+        self.dropped = dict((name, 0) for name in STREAM_NAMES.values())
+        self.write_meta()
+
+        BackgroundWriter.__init__(self, "SessionRecorder", max_queued, batch_size)
+
+    def timestamp(self, at=None):
+        """
+        :param at: timer() value, None for now
+        :return: seconds since the start of the session
+        """
+        return (timer() if at is None else at) - self.started
+
+    def submit(self, stream, data, at=None):
+        """
+        Queues one record, never blocks.
+        :return: False if the record had to be dropped because the writer doesn't keep up
+        """
+        if self.put((self.timestamp(at), stream, data)):
+            return True
+        self.dropped[STREAM_NAMES[stream]] += 1
+        return False
+
+    def add_command(self, route, args):
+        """
+        :param route: path of the request, eg "/say_text"
+        :param args: dict of the query parameters (and the JSON body, if any)
+        """
+        return self.submit(COMMAND, {"type": "command", "route": route, "args": args})
+
+    def add_touch(self, touch):
+        """
+        :param touch: dict of the touch event, like published on the event hub
+        """
+        return self.submit(TOUCH, dict(touch, type="touch_" + touch["type"]))
+
+    def add_audio(self, chunk, received_at):
+        """
+        :param chunk: array of shape (channels, samples) from the audio pipeline
+        :param received_at: timer() value of when the chunk arrived, the chunk is timestamped with when it started
+        """
+        if chunk.shape[0] != self.channels:
+            return False
+        return self.submit(AUDIO, chunk, at=received_at - chunk.shape[1] / float(self.sample_rate))
+
+    def add_frame(self, jpeg_bytes):
+        return self.submit(CAMERA, jpeg_bytes)
+
+    def write_batch(self, batch):
+        for t, stream, data in batch:
+            if stream == AUDIO:
+                data = data.T.tobytes()  # sample by sample, all channels of a sample after each other
+            elif stream in (COMMAND, TOUCH):
+                data = json.dumps(dict(data, t=round(t, 4))) + "\n"
+
+            filename = STREAM_FILES[stream]
+            self.files[filename].write(data)
+            self.index.write(INDEX_RECORD.pack(t, stream, self.offsets[filename], len(data)))
+            self.offsets[filename] += len(data)
+            self.written[STREAM_NAMES[stream]] += 1
+
+        # make the batch visible to readers, without syncing after every single record
+        for f in self.files.values():
+            f.flush()
+        self.index.flush()
+
+    def close(self):
+        try:
+            audio = self.files["audio.wav"]
+            audio.seek(0)
+            audio.write(wav_header(self.sample_rate, self.channels, self.offsets["audio.wav"] - self.audio_header_size))
+        finally:
+            for f in self.files.values():
+                f.close()
+            self.index.close()
+            self.write_meta(duration=self.timestamp())
+
+    def write_meta(self, duration=None):
+        with open(os.path.join(self.session_dir, "session.json"), "w") as f:
+            json.dump({
+                "started_at": self.started_at,
+                "duration": duration,
+                "sample_rate": self.sample_rate,
+                "channels": self.channels,
+                "written": self.written,
+                "dropped": self.dropped
+            }, f, indent=2)
+
+    def stats(self):
+        stats = BackgroundWriter.stats(self)
+        stats["session_dir"] = self.session_dir
+        stats["duration"] = round(self.timestamp(), 3)
+        stats["written"] = dict(self.written)
+        stats["dropped"] = dict(self.dropped)
+        return stats
+
+
+class SessionReader(object):
+    """
+    Reads a recorded session, for replaying it or cutting out a time range. Only the index is loaded, the records are
+    read from the stream files when they are needed.
+    """
+
+    def __init__(self, session_dir):
+        self.session_dir = session_dir
+        with open(os.path.join(session_dir, "session.json")) as f:
+            self.meta = json.load(f)
+
+        self.index = np.fromfile(os.path.join(session_dir, "index.bin"), dtype=INDEX_DTYPE)
+        if len(self.index) > 1 and np.any(np.diff(self.index["t"]) < 0):
+            # audio is stamped with the start of the chunk, so it can be a bit older than what was written before it
+            self.index = self.index[np.argsort(self.index["t"], kind="mergesort")]
+        self.files = {}
+
+    def entries(self, start=None, end=None, streams=None):
+        """
+        :param start: seconds since the start of the session, None for the beginning
+        :param end: seconds since the start of the session (exclusive), None for the end
+        :param streams: collection of stream names (command, touch, audio, camera), None for all
+        :return: the index records of the time range, sorted by time. Found by binary search
+        """
+        lo = 0 if start is None else np.searchsorted(self.index["t"], start, side="left")
+        hi = len(self.index) if end is None else np.searchsorted(self.index["t"], end, side="left")
+        entries = self.index[lo:hi]
+        if streams is not None:
+            ids = [stream for stream, name in STREAM_NAMES.items() if name in streams]
+            entries = entries[np.in1d(entries["stream"], ids)]
+        return entries
+
+    def read(self, entry):
+        """
+        :return: the record of an index entry: a dict for commands and touches, an array of shape (channels, samples)
+        for audio and the JPEG bytes for camera frames
+        """
+        filename = STREAM_FILES[int(entry["stream"])]
+        if filename not in self.files:
+            self.files[filename] = open(os.path.join(self.session_dir, filename), "rb")
+        f = self.files[filename]
+        f.seek(int(entry["offset"]))
+        data = f.read(int(entry["length"]))
+
+        if filename == "events.jsonl":
+            return json.loads(data)
+        if filename == "audio.wav":
+            return np.frombuffer(data, dtype=np.int16).reshape((self.meta["channels"], -1), order="F")
+        return data
+
+    def slice(self, start=None, end=None, streams=None):
+        """
+        :return: generator of (seconds since the start of the session, stream name, record) of the time range
+        """
+        for entry in self.entries(start, end, streams):
+            yield float(entry["t"]), STREAM_NAMES[int(entry["stream"])], self.read(entry)
+
+    def replay(self, start=None, end=None, streams=None, speed=1.0):
+        """
+        Like slice, but yields the records with the timing they were recorded with.
+        :param speed: 2.0 replays twice as fast
+        """
+        replay_started = timer()
+        first = None
+        for t, stream, record in self.slice(start, end, streams):
+            if first is None:
+                first = t
+            time.sleep(max(0.0, (t - first) / speed - (timer() - replay_started)))
+            yield t, stream, record
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
@@ -1,16 +1,26 @@
 """
     Implements a naoqi ALModule for live streaming of Pepper's microphone to default host default audio output device.
     Based on: https://github.com/JBramauer/pepperspeechrecognition/blob/master/module_speechrecognition.py
+    The same audio can also be streamed to browsers, see the consumers of the pipeline, the host doesn't even need an
+    audio output device for that.
 
     Author: Finn Rietz
 """
 
-import sounddevice as sd
-from sounddevice import PortAudioError
+try:
+    import sounddevice as sd
+    from sounddevice import PortAudioError
+except (ImportError, OSError):
+    # sounddevice or the PortAudio library isn't installed (eg headless server), no playback on the host then
+    sd = None
 import time
+import wave
+import logging
 import numpy as np
 
-from utils import rawToWav
+from audio_buffer import AudioRingBuffer
+from audio_pipeline import AudioPipeline
+from audio_pipeline import JitterBufferPlayback
 
 import naoqi
 from naoqi import ALProxy
@@ -21,11 +31,22 @@ IP = "130.239.182.11"
 PORT = 9559
 MOD_NAME = "SpeechRecognition"
 
+log = logging.getLogger("woz4u.audio")
+
 
 #  we need to inherit from ALModule so that we can subscribe to the audio device...
 class SpeechRecognitionModule(naoqi.ALModule):
 
-    def __init__(self, strModuleName, strNaoIp, noaPort):
+    def __init__(self, strModuleName, strNaoIp, noaPort, retention=60.0, max_buffer_bytes=32 * 1024 * 1024,
+                 playback_latency=0.1, max_playback_latency=0.5, livestream=True, consumers=()):
+        """
+        :param retention: seconds of the newest audio kept in memory for save_buffer()
+        :param max_buffer_bytes: hard cap for the memory of the audio buffer
+        :param playback_latency: seconds of audio the jitter buffer of the live playback starts with
+        :param max_playback_latency: the jitter buffer never holds more, older audio is dropped
+        :param livestream: whether the audio is played on the output device of the host, needs sounddevice
+        :param consumers: further consumers for the pipeline, eg the AudioFanout streaming to the browsers
+        """
 
         # kill previous instance, useful for developing ;)
         try:
@@ -51,16 +72,22 @@ class SpeechRecognitionModule(naoqi.ALModule):
 
         self.audio = naoqi.ALProxy("ALAudioDevice")
 
-        # audio buffer
-        self.buffer = []
+        # audio buffer, only keeps the newest retention seconds
+        self.buffer = AudioRingBuffer(SAMPLE_RATE, CHANNELS, retention=retention, max_bytes=max_buffer_bytes)
 
-        self.stream_latency = 0.5
+        # latency of the sounddevice stream itself, the jitter buffer of the playback comes on top
+        self.stream_latency = 0.1
 
-        # sounddevice stream for audio playback in realtime
-        # dtype=np.int16 is very important! This fixes the insane static noises
-        self.stream = sd.OutputStream(channels=CHANNELS, samplerate=SAMPLE_RATE, dtype=np.int16, latency=self.stream_latency)
+        # the callback only queues the chunks, the pipeline thread hands them to the buffer and the live playback
+        self.pipeline = AudioPipeline()
+        self.pipeline.add_consumer(self.buffer_chunk)
+        self.playback = JitterBufferPlayback(self.open_stream, SAMPLE_RATE, target_latency=playback_latency,
+                                             max_latency=max_playback_latency)
+        self.pipeline.add_consumer(self.playback)
+        for consumer in consumers:
+            self.pipeline.add_consumer(consumer)
 
-        self.livestream = True
+        self.livestream = livestream and sd is not None
 
         self.isStarted = False
 
@@ -72,6 +99,11 @@ class SpeechRecognitionModule(naoqi.ALModule):
             self.strNaoIp,  # parent broker IP
             self.naoPort)   # parent broker port
 
+    def open_stream(self):
+        # sounddevice stream for audio playback in realtime
+        # dtype=np.int16 is very important! This fixes the insane static noises
+        return sd.OutputStream(channels=CHANNELS, samplerate=SAMPLE_RATE, dtype=np.int16, latency=self.stream_latency)
+
     def start(self):
         # audio = naoqi.ALProxy("ALAudioDevice")
         nNbrChannelFlag = 3  # ALL_Channels: 0,  AL::LEFTCHANNEL: 1, AL::RIGHTCHANNEL: 2 AL::FRONTCHANNEL: 3  or AL::REARCHANNEL: 4.
@@ -83,24 +115,24 @@ class SpeechRecognitionModule(naoqi.ALModule):
         # needs to have a "process" method that will be used as callback...
         self.audio.subscribe(self.getName())
 
-        # also start the sounddevice stream so that we can write data on it
-        try:
-            self.stream.start()
-            self.isStarted = True
-            # print "SD STREAM ACTIVE: ", self.stream.active
-        except PortAudioError:
-            # when stream has been closed, pointer become invalid, so we have to make a new stream
-            self.stream = sd.OutputStream(channels=CHANNELS, samplerate=SAMPLE_RATE, dtype=np.int16, latency=self.stream_latency)
-            self.stream.start()
-            self.isStarted = True
+        self.pipeline.start()
+
+        # also start the playback, it opens a new sounddevice stream every time
+        if self.livestream:
+            try:
+                self.playback.start()
+            except PortAudioError as e:
+                log.warning("No audio playback on this host: %s", e)
+        self.isStarted = True
 
     def stop(self):
         if not self.isStarted:
             return
         else:
             self.isStarted = False
-            self.stream.close()
             self.audio.unsubscribe(self.getName())
+            self.playback.stop()
+            self.pipeline.stop()
 
     def processRemote(self, nbOfChannels, nbrOfSamplesByChannel, aTimeStamp, buffer):
         """
@@ -118,36 +150,49 @@ class SpeechRecognitionModule(naoqi.ALModule):
             # timestamp = float(str(aTimeStamp[0]) + "." + str(aTimeStamp[1]))
             # print str(timestamp), "processRemote!!!!"
 
-            aSoundDataInterlaced = np.fromstring(str(buffer), dtype=np.int16)
-            aSoundData = np.reshape(aSoundDataInterlaced, (nbOfChannels, nbrOfSamplesByChannel), 'F')
+            # views on the buffer of naoqi, no copies. Everything else happens on the pipeline and playback threads
+            aSoundDataInterlaced = np.frombuffer(buffer, dtype=np.int16)
+            aSoundData = aSoundDataInterlaced.reshape((nbOfChannels, nbrOfSamplesByChannel), order='F')
+            self.pipeline.submit(aSoundData)
 
-            self.buffer.append(aSoundData)
+    def buffer_chunk(self, chunk, received_at):
+        if chunk.shape[0] == self.buffer.channels:
+            self.buffer.write(chunk)
 
-            # write the callback data from ALAudiodevice to sounddevice stream, causing it to be played
-            # we need to transpose, because sounddevice expects columns to be channels, and we get rows as channels
-            if self.livestream:
-                print np.shape(aSoundData)
-                self.stream.write(aSoundData.T)
-
-    def save_buffer(self):
+    def stats(self):
+        """
+        :return: dict with the counters of the audio path and the latency of the live playback
+        """
+        stats = self.playback.stats()
+        stats["chunks"] = self.pipeline.chunks
+        stats["queued_chunks"] = self.pipeline.queue.qsize()
+        stats["dropped_chunks"] = self.pipeline.overruns
+        stats["retained_seconds"] = round(self.buffer.duration(), 3)
+        return stats
+
+    def save_buffer(self, seconds=None, filename="simple_out"):
         """
-        Saves buffered audio data to physical .wav file.
+        Saves buffered audio data to physical .wav file, in one go without a temporary .raw file.
+        For continuous recordings see audio_recorder.WavRecorder.
+        :param seconds: only save the newest seconds, None for everything that is buffered
         :return:
         """
-        filename = "simple_out"
-        outfile = open(filename + ".raw", "wb")
-        data = self.transform_buffer()
-        data.tofile(outfile)
+        data = self.transform_buffer(seconds)
+        outfile = wave.open(filename + ".wav", "wb")
+        outfile.setframerate(SAMPLE_RATE)
+        outfile.setnchannels(CHANNELS)
+        outfile.setsampwidth(2)
+        outfile.writeframes(data.tobytes())
         outfile.close()
-        rawToWav(filename)
-        print filename
+        log.info("Saved audio buffer to %s.wav", filename)
 
-    def transform_buffer(self):
+    def transform_buffer(self, seconds=None):
         """
         Reshapes buffer matrix to 1d array of microphone energy values, so that it can be treated as audio data
+        :param seconds: only the newest seconds, None for everything that is buffered
         :return:
         """
-        return np.concatenate(self.buffer, axis=1)[0]
+        return self.buffer.last(seconds)[0]
 
 
 def main():
@@ -0,0 +1,113 @@
+"""
+    Background poller that keeps an in-memory snapshot of the robot state.
+    Instead of every open frontend tab querrying ~20 naoqi getters per second, one thread refreshes the snapshot at a
+    fixed rate (all getters are issued concurrently as qi futures) and /querry_states just returns the latest copy.
+"""
+
+import logging
+import threading
+from timeit import default_timer as timer
+
+
+log = logging.getLogger("woz4u.state")
+
+
+class RobotStatePoller(object):
+
+    def __init__(self, querries, interval=0.5, max_age=3.0, rpc_timeout=2.0, on_change=None):
+        """
+        :param querries: list of (key, service, method name, args, transform) tuples. Every method is called
+        asynchronously on the service with the given args, transform (or None) is applied to the returned value.
+        :param interval: seconds between two refreshes of the snapshot
+        :param max_age: after how many seconds without successful refresh the snapshot is considered dead
+        :param rpc_timeout: how many seconds we wait for a single naoqi call to return
+        :param on_change: optional callback, called with a dict of only the changed values whenever a refresh changed
+        the snapshot
+        """
+        self.querries = querries
+        self.interval = interval
+        self.max_age = max_age
+        self.rpc_timeout = rpc_timeout
+        self.on_change = on_change
+
+        self.lock = threading.Lock()
+        self.values = {}
+        self.version = 0
+        self.refreshed_at = None  # timer() of the last successful refresh
+        self.last_error = None
+
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="RobotStatePoller")
+        self.thread.daemon = True  # never keep the server alive because of this
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            started = timer()
+            try:
+                self.refresh()
+            except RuntimeError as e:
+                # session died or robot doesn't answer, keep old snapshot and let it age
+                self.last_error = str(e)
+            except Exception as e:
+                # eg a transform that didn't expect the value, one bad refresh must not end the poller
+                log.exception("Refreshing the robot state failed")
+                self.last_error = str(e)
+
+            # keep a steady rate, no matter how long the robot took to answer
+            self.stop_event.wait(max(0.0, self.interval - (timer() - started)))
+
+    def refresh(self):
+        """
+        Issues all querries concurrently and swaps in the new snapshot once all of them returned.
+        Raises RuntimeError if any of the calls failed, in which case the previous snapshot is kept.
+        """
+        futures = []
+        for key, service, method, args, transform in self.querries:
+            futures.append((key, transform, getattr(service, method)(*args, _async=True)))
+
+        values = {}
+        for key, transform, future in futures:
+            value = future.value(int(self.rpc_timeout * 1000))  # qi wants the timeout in ms
+            values[key] = transform(value) if transform is not None else value
+
+        with self.lock:
+            changed = dict((key, value) for key, value in values.items()
+                           if key not in self.values or self.values[key] != value)
+            if changed:
+                self.values = values
+                self.version += 1
+            self.refreshed_at = timer()
+            self.last_error = None
+
+        if changed and self.on_change is not None:
+            self.on_change(changed)
+
+    def age(self):
+        """
+        :return: seconds since the last successful refresh, None if there never was one
+        """
+        if self.refreshed_at is None:
+            return None
+        return timer() - self.refreshed_at
+
+    def is_fresh(self):
+        age = self.age()
+        return age is not None and age <= self.max_age
+
+    def snapshot(self):
+        """
+        :return: tuple of (version, age in seconds, copy of the querried values)
+        """
+        with self.lock:
+            return self.version, self.age(), dict(self.values)
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from touch_store import TouchStore
+
+
+class TouchStoreClearTest(unittest.TestCase):
+
+    def setUp(self):
+        self.touches = TouchStore()
+        self.touches.touch_down(0.1, 0.2)
+        self.touches.touch_move(0.2, 0.3)
+        self.touches.touch_up()
+
+    def test_clear_takes_a_new_seq(self):
+        before = self.touches.seq
+        self.assertEqual(self.touches.clear(), before + 1)
+
+    def test_client_at_pre_clear_cursor_sees_the_clear(self):
+        cursor = self.touches.seq
+        self.touches.clear()
+
+        seq, events = self.touches.events_since(cursor)
+        self.assertIsNone(events)  # has to fetch everything again
+        self.assertEqual(seq, cursor + 1)
+
+    def test_client_after_clear_gets_new_events(self):
+        seq = self.touches.clear()
+        self.touches.touch_down(0.5, 0.5)
+
+        last, events = self.touches.events_since(seq)
+        self.assertEqual(last, seq + 1)
+        self.assertEqual([event["type"] for event in events], ["down"])
+        self.assertEqual(self.touches.touchdowns(), [(0.5, 0.5)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+"""
+    Bounded store of the touches on the tablet of one robot. Written by the naoqi callback threads, read by the routes
+    of the tablet drawer. The touch events are kept in a ring buffer of plain arrays instead of lists of tuples, so
+    memory stays the same no matter how long the session runs, and getting the newest strokes or the events since the
+    last request only touches those.
+    Every event gets a sequence number, clients remember the last one they got and then only ask for newer events.
+"""
+
+import threading
+from array import array
+
+
+DOWN = 0
+MOVE = 1
+UP = 2
+
+EVENT_TYPES = {DOWN: "down", MOVE: "move", UP: "up"}
+
+
+class TouchStore(object):
+
+    def __init__(self, capacity=4096, max_strokes=256, max_touchdowns=5):
+        """
+        :param capacity: how many touch events (mostly the points of finger slides) are kept, older ones get overwritten
+        :param max_strokes: how many strokes (slides from touch down to touch up) are kept
+        :param max_touchdowns: how many touch down positions are kept
+        """
+        self.capacity = capacity
+        self.max_strokes = max_strokes
+        self.max_touchdowns = max_touchdowns
+        self.lock = threading.RLock()  # reentrant for snapshot
+        self.changed = threading.Condition(self.lock)  # notified on every new event
+
+        # event with sequence number n is at index n % capacity
+        self.types = array("b", [0]) * capacity
+        self.xs = array("d", [0.0]) * capacity
+        self.ys = array("d", [0.0]) * capacity
+        self.seq = 0  # sequence number of the newest event, the first event has 1
+        self.cleared_seq = 0  # events up to this one were cleared
+
+        # stroke n consists of the move events from stroke_starts[n % max_strokes] to stroke_ends[n % max_strokes]
+        self.stroke_starts = array("l", [0]) * max_strokes
+        self.stroke_ends = array("l", [0]) * max_strokes
+        self.stroke_count = 0  # strokes ever started
+        self.stroke_open = False  # whether the next move continues the newest stroke
+
+        self.down_xs = array("d", [0.0]) * max_touchdowns
+        self.down_ys = array("d", [0.0]) * max_touchdowns
+        self.down_count = 0
+
+    def add(self, event_type, x=0.0, y=0.0):
+        # called with the lock held
+        self.seq += 1
+        index = self.seq % self.capacity
+        self.types[index] = event_type
+        self.xs[index] = x
+        self.ys[index] = y
+        self.changed.notify_all()
+        return self.seq
+
+    def touch_down(self, x, y):
+        """
+        :return: sequence number of the event
+        """
+        with self.lock:
+            slot = self.down_count % self.max_touchdowns
+            self.down_xs[slot] = x
+            self.down_ys[slot] = y
+            self.down_count += 1
+            return self.add(DOWN, x, y)
+
+    def touch_move(self, x, y):
+        """
+        :return: sequence number of the event
+        """
+        with self.lock:
+            seq = self.add(MOVE, x, y)
+            if not self.stroke_open:
+                # first move after a touch down, the finger starts a new slide
+                self.stroke_starts[self.stroke_count % self.max_strokes] = seq
+                self.stroke_count += 1
+                self.stroke_open = True
+
+            self.stroke_ends[(self.stroke_count - 1) % self.max_strokes] = seq
+            return seq
+
+    def touch_up(self):
+        """
+        :return: sequence number of the event
+        """
+        with self.lock:
+            self.stroke_open = False
+            return self.add(UP)
+
+    def clear(self):
+        """
+        Forgets all touches. The clear takes a sequence number of its own, so clients notice it: events_since tells
+        every client whose last event is older than the clear to fetch everything again.
+        :return: sequence number of the clear, events after it are kept again
+        """
+        with self.lock:
+            self.seq += 1
+            self.cleared_seq = self.seq
+            self.stroke_count = 0
+            self.stroke_open = False
+            self.down_count = 0
+            self.changed.notify_all()
+            return self.seq
+
+    def oldest_seq(self):
+        # called with the lock held. Sequence number of the oldest event that is still kept
+        return max(self.cleared_seq, self.seq - self.capacity) + 1
+
+    def touchdowns(self, k=None):
+        """
+        :param k: max number of touch downs, None for all that are kept
+        :return: list of (x, y), newest first
+        """
+        with self.lock:
+            count = min(self.down_count, self.max_touchdowns, k if k is not None else self.max_touchdowns)
+            slots = [(self.down_count - 1 - i) % self.max_touchdowns for i in range(count)]
+            return [(self.down_xs[slot], self.down_ys[slot]) for slot in slots]
+
+    def strokes(self, k=5, min_points=1):
+        """
+        :param k: max number of strokes
+        :param min_points: strokes with less points are skipped, eg the few moves of a tap
+        :return: list of the newest strokes (lists of (x, y) points), newest first. Strokes whose first points were
+        already overwritten are cut
+        """
+        strokes = []
+        with self.lock:
+            oldest = self.oldest_seq()
+            for n in range(self.stroke_count - 1, max(-1, self.stroke_count - 1 - self.max_strokes), -1):
+                slot = n % self.max_strokes
+                start = max(self.stroke_starts[slot], oldest)
+                end = self.stroke_ends[slot]
+                if end < oldest:
+                    break  # this and all older strokes are overwritten
+
+                stroke = [(self.xs[seq % self.capacity], self.ys[seq % self.capacity]) for seq in range(start, end + 1)
+                          if self.types[seq % self.capacity] == MOVE]
+                if len(stroke) < min_points:
+                    continue
+
+                strokes.append(stroke)
+                if len(strokes) == k:
+                    break
+
+        return strokes
+
+    def snapshot(self, k_touchdowns=5, k_strokes=5, min_points=1):
+        """
+        :return: tuple of (sequence number of the newest event, touchdowns(k_touchdowns), strokes(k_strokes,
+        min_points)), all from the same moment, so a client can continue with events_since from that sequence number
+        """
+        with self.lock:
+            return self.seq, self.touchdowns(k_touchdowns), self.strokes(k_strokes, min_points)
+
+    def events_since(self, since, wait=0.0, limit=None):
+        """
+        :param since: sequence number of the last event the client has
+        :param wait: if there are no newer events, wait up to this many seconds for one (long poll)
+        :param limit: max number of events, the oldest ones are returned first
+        :return: tuple of (sequence number of the newest event, list of event dicts with seq, type, x and y). None
+        instead of the list if events the client doesn't have yet were overwritten or cleared, then it needs everything
+        """
+        with self.lock:
+            if self.seq <= since and wait > 0:
+                # python 2 waits with a timeout by polling in steps of up to 50ms, fine for the touches
+                self.changed.wait(wait)
+
+            if since < self.oldest_seq() - 1 or since > self.seq:
+                # the client missed a clear or overwritten events, or still has the numbers of an earlier server run
+                return self.seq, None
+
+            last = self.seq if limit is None else min(self.seq, since + limit)
+            events = []
+            for seq in range(since + 1, last + 1):
+                index = seq % self.capacity
+                event = {"seq": seq, "type": EVENT_TYPES[self.types[index]]}
+                if self.types[index] != UP:
+                    event["x"] = self.xs[index]
+                    event["y"] = self.ys[index]
+                events.append(event)
+
+            return last, events
@@ -2,11 +2,13 @@ from PIL import Image
 import io
 import wave
 import os
+import time
+import logging
+from timeit import default_timer as timer
 
 
 def is_video(path):
     ext = path.split(".")[-1]
-    print(ext)
     if ext in ["mp4", "m4v", "mkv", "webm", "mov", "avi", "wmv", "mpg", "flv"]:
         return True
     else:
@@ -33,9 +35,37 @@ def is_external_path(path):
         return False
 
 
+def wait_for_value(getter, expected, timeout=1.0, interval=0.02, tolerance=None):
+    """
+    Polls a naoqi getter until the robot reports the expected value, to confirm that a setting has been applied.
+    Returns as soon as it is confirmed, instead of sleeping for a fixed time.
+    :param getter: callable without arguments, eg ab_srv.isEnabled
+    :param expected: the value we wait for
+    :param timeout: max seconds to wait
+    :param interval: seconds between two calls of the getter
+    :param tolerance: max absolute difference for numeric values, None for exact comparison
+    :return: tuple of the last value returned by getter, seconds waited and whether the value was confirmed
+    """
+    started = timer()
+    while True:
+        value = getter()
+        waited = timer() - started
+
+        if tolerance is None:
+            confirmed = value == expected
+        else:
+            confirmed = abs(value - expected) <= tolerance
+        if confirmed or waited >= timeout:
+            return value, waited, confirmed
+
+        time.sleep(interval)
+
+
 def alImage_to_PIL(alImg):
     """
     Converts a ALImage from the naoqi API ALVideoDeviceProxy::getImageRemote.
+    The pixel data is handed to Pillow as buffer, without intermediate copies. Pillow still unpacks it once into its
+    own (4 bytes per pixel) RGB storage, that copy can't be avoided.
     :param alImg: The ALimage object as returned from the API.
     :return: A Pillow image.
     """
@@ -43,12 +73,63 @@ def alImage_to_PIL(alImg):
     im_h = alImg[1]
     im_arr = alImg[6]
 
-    im_str = str(bytearray(im_arr))
-    pil_img = Image.frombytes("RGB", (im_w, im_h), im_str)
+    pil_img = Image.frombuffer("RGB", (im_w, im_h), as_buffer(im_arr), "raw", "RGB", 0, 1)
 
     return pil_img
 
 
+def as_buffer(data):
+    """
+    Wraps binary image data from naoqi so that Pillow can read it without copying it first.
+    :param data: str, bytearray or anything else supporting the buffer interface
+    :return: an object Pillow's decoders can read from directly
+    """
+    if isinstance(data, str):
+        return data  # already what Pillow wants
+    try:
+        return buffer(data)
+    except TypeError:
+        # eg list of ints, nothing to wrap, so we have to copy after all
+        return str(bytearray(data))
+
+
+class JpegEncoder(object):
+    """
+    Encodes Pillow images to JPEG, reusing the same output buffer for all frames instead of allocating a new BytesIO
+    per frame. Not thread safe, use one encoder per thread.
+    """
+
+    def __init__(self, quality=75):
+        self.quality = quality
+        self.buffer = io.BytesIO()
+
+    def encode(self, pil_img, quality=None):
+        """
+        :param pil_img: The pillow image object
+        :param quality: JPEG quality for this frame, the encoder default if None
+        :return: The jpeg bytes
+        """
+        self.buffer.seek(0)
+        pil_img.save(self.buffer, format="jpeg", quality=quality or self.quality)
+
+        # cut off leftovers of a bigger previous frame, the allocated memory is kept for the next one
+        self.buffer.truncate(self.buffer.tell())
+
+        return self.buffer.getvalue()
+
+
+def alImage_to_JPEG(alImg, encoder, quality=None):
+    """
+    Converts a ALImage from ALVideoDeviceProxy::getImageRemote directly to JPEG bytes.
+    :param alImg: The ALimage object as returned from the API.
+    :param encoder: the JpegEncoder to use
+    :param quality: JPEG quality, the encoder default if None
+    :return: Tuple of the Pillow image and the jpeg bytes
+    """
+    pil_img = alImage_to_PIL(alImg)
+    return pil_img, encoder.encode(pil_img, quality)
+
+
 def PIL_to_JPEG_BYTEARRAY(pil_img):
     """
     Converts a Pillow image to a JPEG bytearray
@@ -77,7 +158,7 @@ def rawToWav(filename):
 
     f = open(rawfile, "rb")
     sample = f.read(4096)
-    print 'writing file: ' + filename + '.wav'
+    logging.getLogger("woz4u.audio").info("Writing file %s.wav", filename)
 
     while sample != "":
         outfile.writeframes(sample)
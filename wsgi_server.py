@@ -0,0 +1,119 @@
+"""
+    Run modes of the server, selected with --server:
+    "dev" is the Werkzeug development server with debugger and reloader, like it always was. "threaded" serves the
+    requests from a fixed pool of worker threads with HTTP/1.1 keep-alive, "cheroot" uses the cheroot WSGI server
+    (pip install cheroot) instead.
+    All modes run in a single process, because the robot sessions, camera broadcasters and the event hub live in it.
+    There is no cooperative (gevent) mode either, naoqi calls block the native thread and would stall all greenlets.
+"""
+
+import threading
+import socket
+import logging
+import Queue
+
+from werkzeug.serving import BaseWSGIServer
+from werkzeug.serving import WSGIRequestHandler
+
+
+SERVER_MODES = ["dev", "threaded", "cheroot"]
+
+log = logging.getLogger("woz4u.server")
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug server that hands the accepted connections to a fixed number of worker threads, instead of starting a
+    thread per connection. Every open MJPEG or event stream occupies a worker as long as it is open, and so does an
+    idle keep-alive connection until the timeout, so the pool has to be a good bit larger than the number of streams.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=64, timeout=10.0, keep_alive=True):
+        """
+        :param threads: number of worker threads
+        :param timeout: seconds until idle keep-alive connections and clients that stopped sending or reading are closed
+        :param keep_alive: whether connections are reused for several requests (HTTP/1.1)
+        """
+        handler = type("PooledRequestHandler", (WSGIRequestHandler,), {
+            "protocol_version": "HTTP/1.1" if keep_alive else "HTTP/1.0",
+            "timeout": timeout,  # applied to the socket of every connection
+        })
+        BaseWSGIServer.__init__(self, host, port, app, handler=handler)
+
+        self.threads = threads
+        # the accepting thread waits once this many connections wait for a worker, the rest waits in the listen backlog
+        self.connections = Queue.Queue(maxsize=threads)
+        self.lock = threading.Lock()
+        self.busy = 0
+
+        for i in range(threads):
+            worker = threading.Thread(target=self.work, name="WSGIWorker-{}".format(i))
+            worker.daemon = True
+            worker.start()
+
+    def get_request(self):
+        connection, client_address = BaseWSGIServer.get_request(self)
+        # the status line and every header are separate small writes, with Nagle's algorithm they run into the delayed
+        # ACK of the client on keep-alive connections (~40ms per request)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection, client_address
+
+    def process_request(self, request, client_address):
+        self.connections.put((request, client_address))
+
+    def work(self):
+        while True:
+            request, client_address = self.connections.get()
+            with self.lock:
+                self.busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.lock:
+                    self.busy -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "threads": self.threads,
+                "busy": self.busy,
+                "waiting": self.connections.qsize()
+            }
+
+
+def run_server(app, mode="dev", host="0.0.0.0", port=5000, threads=64, timeout=10.0, keep_alive=True):
+    """
+    Serves the app until it gets interrupted.
+    :param mode: one of SERVER_MODES
+    :param threads: worker threads of the threaded and the cheroot server
+    :param timeout: socket timeout in seconds of the threaded and the cheroot server
+    :param keep_alive: HTTP/1.1 keep-alive for the threaded server, cheroot always keeps connections alive
+    """
+    if mode == "dev":
+        app.run(host=host, port=port, debug=True)
+
+    elif mode == "threaded":
+        server = PooledWSGIServer(host, port, app, threads=threads, timeout=timeout, keep_alive=keep_alive)
+        log.info("Running on http://%s:%s/ with %s worker threads", host, port, threads)
+        server.serve_forever()
+
+    elif mode == "cheroot":
+        try:
+            from cheroot import wsgi
+        except ImportError:
+            raise SystemExit("cheroot is not installed, run 'pip install cheroot' or use --server threaded")
+
+        server = wsgi.Server((host, port), app, numthreads=threads, timeout=int(timeout))
+        log.info("Running on http://%s:%s/ with %s cheroot threads", host, port, threads)
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            server.stop()
+
+    else:
+        raise ValueError("Unknown server mode '{}', expected one of {}".format(mode, SERVER_MODES))